@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+EXTRACT = os.path.join(DIRECTORY, "extract-bdhydro.py")
+MODIFY = os.path.join(DIRECTORY, "modify-bdhydro-osmtags.py")
+
+SMALL_OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" upload="false" generator="benchmark-startup.py">
+\t<node lon="2.0" lat="45.0" id="-1"/>
+\t<node lon="2.001" lat="45.001" id="-2"/>
+\t<way id="-3">
+\t\t<nd ref="-1"/>
+\t\t<nd ref="-2"/>
+\t\t<tag k="NOM_C_EAU" v="RUISSEAU"/>
+\t\t<tag k="LARGEUR" v="Entre 0 et 15 m"/>
+\t</way>
+</osm>
+"""
+
+
+def get_commands(directory):
+    small_osm = os.path.join(directory, "small.osm")
+    with open(small_osm, "w", encoding="utf-8") as f:
+        f.write(SMALL_OSM)
+    return [
+        ("python", [sys.executable, "-c", "pass"]),
+        ("import fiona, osgeo", [sys.executable, "-c", "import fiona.crs, osgeo.osr"]),
+        ("extract-bdhydro.py --help", [sys.executable, EXTRACT, "--help"]),
+        ("modify-bdhydro-osmtags.py --help", [sys.executable, MODIFY, "--help"]),
+        ("modify-bdhydro-osmtags.py small.osm",
+         [sys.executable, MODIFY, small_osm, os.path.join(directory, "out.osm")]),
+    ]
+
+
+def measure(command, repetitions):
+    """Return the durations in seconds of the runs of command, or None if
+    it fails."""
+    durations = []
+    for i in range(repetitions):
+        start = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None
+    return durations
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Mesure le temps de démarrage des scripts, qui domine le"
+                    " traitement de nombreux petits fichiers")
+    parser.add_argument('-n', '--repetitions', dest='repetitions', type=int, default=10,
+                        help="Nombre d'exécutions de chaque commande (défaut: 10)")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        print("{0:40} {1:>10} {2:>10}".format("command", "min ms", "median ms"))
+        for name, command in get_commands(directory):
+            durations = measure(command, args.repetitions)
+            if durations is None:
+                print("{0:40} {1:>21}".format(name, "failed"))
+            else:
+                print("{0:40} {1:10.1f} {2:10.1f}".format(
+                    name, 1000 * min(durations), 1000 * statistics.median(durations)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
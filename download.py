@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+
+Resumable and verified download of large files over HTTP(S) or FTP
+
+The file is downloaded in filename.tmp, resumed from its size with ranged
+requests (HTTP Range, FTP REST) after an interruption, and renamed to
+filename once its checksum is verified. When the server supports ranged
+requests, large files are downloaded in several parallel segments, saved
+in filename.tmp.<start>-<end> until they are concatenated.
+
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+import ftplib
+import hashlib
+import argparse
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+import concurrent.futures
+
+VERBOSE = True
+
+BLOCK_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+RETRIES = 5
+RETRY_DELAY = 2 # in seconds, multiplied by the attempt number
+TIMEOUT = 60 # in seconds
+
+# errors after which the download is resumed
+TRANSIENT_ERRORS = ftplib.all_errors + (http.client.HTTPException,)
+
+
+class HttpSource(object):
+    def __init__(self, url):
+        self.url = url
+    def probe(self):
+        """ Return the size of the file (None if unknown) and whether ranged
+            requests are supported.
+        """
+        request = urllib.request.Request(self.url, headers={"Range": "bytes=0-0"})
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            content_range = response.headers.get("Content-Range", "")
+            match = re.match(r"bytes 0-0/(\d+)", content_range)
+            if response.status == 206 and match:
+                return int(match.group(1)), True
+            length = response.headers.get("Content-Length")
+            return (int(length) if length else None), False
+    def read(self, offset, length, write):
+        """ Call write() with the blocks of length bytes (up to the end if
+            None) of the file from offset.
+        """
+        headers = {}
+        if offset or length is not None:
+            end = "" if length is None else str(offset + length - 1)
+            headers["Range"] = "bytes={0}-{1}".format(offset, end)
+        request = urllib.request.Request(self.url, headers=headers)
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            if headers and response.status != 206:
+                raise Exception("ranged request not supported by " + self.url)
+            # a response closed early reads as a short one
+            if length is None and response.headers.get("Content-Length"):
+                length = int(response.headers["Content-Length"])
+            copy_blocks(response.read, length, write)
+
+class FtpSource(object):
+    def __init__(self, url):
+        url = urllib.parse.urlparse(url)
+        self.host = url.hostname
+        self.port = url.port or ftplib.FTP_PORT
+        self.user = urllib.parse.unquote(url.username or "anonymous")
+        self.password = urllib.parse.unquote(url.password or "")
+        self.path = urllib.parse.unquote(url.path)
+    def connect(self):
+        ftp = ftplib.FTP(timeout=TIMEOUT)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.password)
+        ftp.voidcmd("TYPE I")
+        return ftp
+    def probe(self):
+        ftp = self.connect()
+        try:
+            size = ftp.size(self.path)
+        except ftplib.error_perm:
+            size = None
+        finally:
+            ftp.close()
+        # servers giving the size in binary mode support REST
+        return size, size is not None
+    def read(self, offset, length, write):
+        ftp = self.connect()
+        try:
+            connection = ftp.transfercmd("RETR " + self.path, rest=offset or None)
+            with connection:
+                copy_blocks(connection.recv, length, write)
+            try:
+                ftp.voidresp()
+            except ftplib.all_errors:
+                # the transfer of a segment is aborted before the end of the file
+                if length is None:
+                    raise
+        finally:
+            ftp.close()
+
+def open_source(url):
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme in ("http", "https"):
+        return HttpSource(url)
+    if scheme == "ftp":
+        return FtpSource(url)
+    raise Exception("unsupported URL: " + url)
+
+def copy_blocks(read, length, write):
+    remaining = length
+    while remaining is None or remaining > 0:
+        block = read(BLOCK_SIZE if remaining is None else min(BLOCK_SIZE, remaining))
+        if not block:
+            break
+        write(block)
+        if remaining is not None:
+            remaining -= len(block)
+    if remaining:
+        raise EOFError("connection closed {0} bytes before the end".format(remaining))
+
+
+class Progress(object):
+    """ Count the downloaded bytes of all the segments and report the
+        throughput every few seconds.
+    """
+    def __init__(self, size, done=0, interval=5):
+        self.size = size
+        self.done = done
+        self.downloaded = 0
+        self.interval = interval
+        self.start = self.last_report = time.monotonic()
+        self.lock = threading.Lock()
+    def resume(self, count):
+        """ Count bytes downloaded by a previous run. """
+        with self.lock:
+            self.done += count
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            self.downloaded += count
+            now = time.monotonic()
+            if VERBOSE and now - self.last_report >= self.interval:
+                self.last_report = now
+                sys.stderr.write("{0} {1:.1f} MB/s\r".format(self.percent(), self.throughput()))
+    def percent(self):
+        if self.size:
+            return "{0:.0f} % ({1:.1f} / {2:.1f} MB)".format(
+                100.0 * self.done / self.size, self.done / 1e6, self.size / 1e6)
+        return "{0:.1f} MB".format(self.done / 1e6)
+    def throughput(self):
+        """ Throughput in MB/s of this run, the resumed bytes excluded. """
+        return self.downloaded / 1e6 / max(time.monotonic() - self.start, 1e-6)
+    def report(self):
+        if VERBOSE:
+            if self.last_report > self.start:
+                sys.stderr.write("\n")
+            sys.stderr.write("downloaded {0:.1f} MB in {1:.0f} s ({2:.1f} MB/s)\n".format(
+                self.downloaded / 1e6, time.monotonic() - self.start, self.throughput()))
+
+
+def with_retries(function, description, position=lambda: None):
+    """ Call function(), again after a transient error. function resumes
+        the download where it stopped: the attempts are counted from the
+        last one making position() progress.
+    """
+    attempt = 0
+    last_position = position()
+    while True:
+        try:
+            return function()
+        except urllib.error.HTTPError as e:
+            if e.code < 500:
+                raise
+            error = e
+        except TRANSIENT_ERRORS as e:
+            error = e
+        if position() != last_position:
+            last_position = position()
+            attempt = 0
+        attempt += 1
+        if attempt == RETRIES:
+            raise error
+        if VERBOSE:
+            sys.stderr.write("\n{0}: {1}, retry {2} / {3}\n".format(
+                description, error, attempt, RETRIES - 1))
+        time.sleep(RETRY_DELAY * attempt)
+
+def download_range(source, filename, start, end, progress, resumable=True):
+    """ Download the bytes start to end (excluded, None for the end of the
+        file) in filename, resuming from its size if resumable.
+    """
+    def resume():
+        offset = start + os.path.getsize(filename)
+        if not resumable and offset > start:
+            progress.add(start - offset)
+            offset = start
+            open(filename, "wb").close()
+        if end is None or offset < end:
+            with open(filename, "ab") as f:
+                def write(block):
+                    f.write(block)
+                    progress.add(len(block))
+                source.read(offset, None if end is None else end - offset, write)
+    if not os.path.exists(filename):
+        open(filename, "wb").close()
+    with_retries(resume, os.path.basename(filename), lambda: os.path.getsize(filename))
+
+def download_segments(source, filename, size, segments, progress):
+    """ Download the file in parallel segments, then concatenate them in
+        filename.
+    """
+    bounds = [(i * size // segments, (i + 1) * size // segments) for i in range(segments)]
+    names = ["{0}.{1}-{2}".format(filename, start, end) for start, end in bounds]
+    remove_stale_segments(filename, names)
+    progress.resume(sum(existing_size(name) for name in names))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as pool:
+        futures = [pool.submit(download_range, source, name, start, end, progress)
+                   for name, (start, end) in zip(names, bounds)]
+        for future in futures:
+            future.result()
+    with open(filename + ".concat", "wb") as f:
+        for name in names:
+            with open(name, "rb") as part:
+                for block in iter(lambda: part.read(BLOCK_SIZE), b""):
+                    f.write(block)
+    os.replace(filename + ".concat", filename)
+    for name in names:
+        os.remove(name)
+
+def remove_stale_segments(filename, keep=()):
+    """ Remove the segments of a previous download made with other bounds. """
+    for name in glob.glob(glob.escape(filename) + ".*-*"):
+        if name not in keep:
+            os.remove(name)
+
+def existing_size(filename):
+    return os.path.getsize(filename) if os.path.exists(filename) else 0
+
+
+def parse_checksum(checksum):
+    """ Return (algorithm, hex digest) of 'md5:...', 'sha256:...' or of a
+        bare hex digest, its algorithm guessed from its length.
+    """
+    if ":" in checksum:
+        algorithm, digest = checksum.split(":", 1)
+    else:
+        algorithm = {32: "md5", 40: "sha1", 64: "sha256"}.get(len(checksum))
+        digest = checksum
+        if algorithm is None:
+            raise ValueError("unknown checksum " + checksum)
+    return algorithm.lower(), digest.strip().lower()
+
+def file_checksum(filename, algorithm):
+    h = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def get_sidecar_checksum(url):
+    """ Return the checksum published next to the file (url.md5 or
+        url.sha256), or None if there is none.
+    """
+    for algorithm in ("sha256", "md5"):
+        blocks = []
+        try:
+            open_source(url + "." + algorithm).read(0, None, blocks.append)
+        except Exception:
+            continue
+        match = re.match(r"\s*([0-9a-fA-F]+)\b", b"".join(blocks).decode("ascii", "replace"))
+        if match:
+            return algorithm + ":" + match.group(1)
+    return None
+
+
+def download(url, filename, checksum=None, segments=4):
+    """ Download url in filename, resuming a previous download, and verify
+        its checksum ('md5:...', 'sha256:...', see parse_checksum) if given.
+    """
+    tmp_filename = filename + ".tmp"
+    source = open_source(url)
+    size, ranges = with_retries(source.probe, url)
+    if not ranges and os.path.exists(tmp_filename):
+        # can not be resumed
+        os.remove(tmp_filename)
+    if VERBOSE:
+        sys.stderr.write("download {0} ({1})\n".format(
+            url, "size unknown" if size is None else "{0:.1f} MB".format(size / 1e6)))
+    progress = Progress(size, existing_size(tmp_filename))
+    if (ranges and size is not None and segments > 1 and size >= 2 * MIN_SEGMENT_SIZE
+            and not os.path.exists(tmp_filename)):
+        segments = min(segments, size // MIN_SEGMENT_SIZE)
+        download_segments(source, tmp_filename, size, segments, progress)
+    else:
+        # after an interruption during the concatenation of the segments,
+        # filename.tmp holds their beginning
+        remove_stale_segments(tmp_filename)
+        download_range(source, tmp_filename, 0, size if ranges else None, progress, ranges)
+    progress.report()
+    if size is not None and os.path.getsize(tmp_filename) != size:
+        raise Exception("{0}: {1} bytes downloaded instead of {2}".format(
+            filename, os.path.getsize(tmp_filename), size))
+    if checksum:
+        algorithm, digest = parse_checksum(checksum)
+        if file_checksum(tmp_filename, algorithm) != digest:
+            os.remove(tmp_filename)
+            raise Exception("{0}: wrong {1} checksum".format(filename, algorithm))
+        if VERBOSE:
+            sys.stderr.write("{0} checksum verified\n".format(algorithm))
+    elif VERBOSE:
+        sys.stderr.write("no checksum, {0} not verified\n".format(filename))
+    os.replace(tmp_filename, filename)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Télécharge un fichier en HTTP ou FTP, reprend un téléchargement"
+                    " interrompu et vérifie sa somme de contrôle")
+    parser.add_argument('url', metavar="URL")
+    parser.add_argument('filename', metavar="FICHIER", nargs='?',
+                        help="Fichier téléchargé (défaut: nom du fichier de l'URL)")
+    parser.add_argument('--somme-controle', dest='checksum', metavar="ALGO:SOMME",
+                        help="Somme de contrôle attendue (md5:... ou sha256:...), par défaut"
+                             " celle publiée à côté du fichier (URL.md5 ou URL.sha256)")
+    parser.add_argument('--segments', dest='segments', type=int, default=4,
+                        help="Nombre de segments téléchargés en parallèle (défaut: 4)")
+    args = parser.parse_args(argv)
+    filename = args.filename or os.path.basename(urllib.parse.urlparse(args.url).path)
+    download(args.url, filename,
+             args.checksum or get_sidecar_checksum(args.url), args.segments)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -13,18 +13,34 @@
 # along with it. If not, see <http://www.gnu.org/licenses/>.
 
 
+import re
 import sys
+import io
+import math
 import gzip
+import glob
+import json
+import fcntl
+import shutil
+import sqlite3
+import hashlib
 import os.path
 import argparse
+import itertools
+import tempfile
+import threading
+import urllib.parse
 import subprocess
 import collections
-import urllib.request
-import xml.sax.saxutils
 import unicodedata
 
-import fiona.crs
-import osgeo.osr
+# fiona and osgeo are only imported by the functions reading shapefiles or
+# transforming coordinates: loading them takes a while, useless for --help,
+# cached extractions or the SQLite and JSON stores. Likewise for the HTTP
+# server and the download modules.
+
+import osm
+import geometry
 
 
 
@@ -34,8 +50,24 @@ PATH_SHP="BDTOPO_3-0_HYDROGRAPHIE_SHP_LAMB93_FXX_2020-09-15/BDTOPO/1_DONNEES_LIV
 
 VERBOSE = True
 
+# Version of the extraction results, to change when the output of
+# extract_river() or the cache keys change so that cached results are not
+# reused.
+RESULT_VERSION = "3"
+
+# Options of extract_river() changing its result:
+# min_order: minimal Strahler order of the tributaries (SQLite store only)
+# simplify: tolerance in metters of the simplification of the troncons
+# tile_size, max_nodes: split the output in tiles of tile_size degrees
+#   and/or chunks of at most max_nodes nodes
+# surfaces: SURFACE_HYDROGRAPHIQUE shapefile of the water surfaces to join
+ExtractOptions = collections.namedtuple(
+    "ExtractOptions", ["min_order", "simplify", "tile_size", "max_nodes", "surfaces"],
+    defaults=[None, None, None, None, None])
+
 
 def extract_troncons_shp(shp_path, search):
+    import fiona.crs
     ids_by_xy = collections.defaultdict(set)
     matched_ids = []
     if VERBOSE:
@@ -49,10 +81,7 @@ def extract_troncons_shp(shp_path, search):
             if VERBOSE and new_percent > percent:
                 percent = new_percent
                 sys.stderr.write("{0} % ({1} / {2})\r".format(percent, i, size))
-            if ((search == item['properties'].get("CODE_CARTH"))
-                or
-                (strip_accents(item['properties'].get("NOM_C_EAU") or "").lower().find(strip_accents(search).lower()) >= 0)
-            ):
+            if matches_search(item['properties'], search):
                 matched_ids.append(i)
             if item['geometry']['type'] == "LineString":
                 coordinates = item["geometry"]["coordinates"]
@@ -63,87 +92,730 @@ def extract_troncons_shp(shp_path, search):
 
         if VERBOSE: sys.stderr.write("\n")
 
-        name = most_frequent([
-            shp[i]['properties'].get("NOM_C_EAU")
-            for i in matched_ids
-            if shp[i]['properties'].get("NOM_C_EAU")
-        ]) or "?"
-        code_carth = most_frequent([
-            shp[i]['properties'].get("CODE_CARTH")
-            for i in matched_ids
-            if shp[i]['properties'].get("CODE_CARTH")
-        ]) or "________"
-        if VERBOSE: sys.stderr.write(code_carth + ": " + name  + "\n")
-
-        def is_anonymous(item):
-            return (
-                (not item['properties'].get("CODE_CARTH"))
-                and
-                (not item['properties'].get("NOM_C_EAU")))
-
-        if VERBOSE: sys.stderr.write("search main\n")
-        main_ids = get_connected_ids(
-            root_ids=matched_ids,
-            item_by_id=shp,
-            ids_by_xy=ids_by_xy,
-            upstream_filter=is_anonymous,
-            downstream_filter=is_anonymous)
-
-        if VERBOSE: sys.stderr.write("search tributary\n")
-        tributary_ids = get_connected_ids(
-            root_ids=main_ids,
-            item_by_id=shp,
-            ids_by_xy=ids_by_xy,
-            upstream_filter=lambda item:True,
-            downstream_filter=is_anonymous)
-
-        main_items = [shp[i] for i in main_ids]
-        tributary_items = [shp[i] for i in tributary_ids]
+        name, code_carth, main_items, tributary_items = \
+            select_river_items(matched_ids, shp, ids_by_xy)
 
     return proj4, name, code_carth, main_items, tributary_items
 
+def extract_troncons_sqlite(db_path, search, min_order=None):
+    """Like extract_troncons_shp(), using the indexes of the database.
+
+    When the catchment tables are present, the tributaries are the troncons
+    upstream of the main river outlets, of Strahler order >= min_order.
+    """
+    if VERBOSE:
+        sys.stderr.write("query {0}\n".format(db_path))
+    with SqliteTroncons(db_path) as troncons:
+        matched_ids = troncons.search(search)
+        if troncons.has_catchments():
+            name, code_carth, main_items, main_ids = \
+                select_river_main_items(matched_ids, troncons, troncons.ids_by_xy)
+            if VERBOSE: sys.stderr.write("query tributary\n")
+            tributary_ids = set(main_ids)
+            tributary_ids.update(troncons.upstream_ids(main_ids, min_order or 0))
+            tributary_items = [troncons[i] for i in tributary_ids]
+        else:
+            name, code_carth, main_items, tributary_items = \
+                select_river_items(matched_ids, troncons, troncons.ids_by_xy)
+    return troncons.proj4, name, code_carth, main_items, tributary_items
+
+def select_river_items(matched_ids, item_by_id, ids_by_xy):
+    """Return the name, code and main/tributary troncons of the river of
+    the matched troncons."""
+    name, code_carth, main_items, main_ids = \
+        select_river_main_items(matched_ids, item_by_id, ids_by_xy)
+
+    if VERBOSE: sys.stderr.write("search tributary\n")
+    tributary_ids = get_connected_ids(
+        root_ids=main_ids,
+        item_by_id=item_by_id,
+        ids_by_xy=ids_by_xy,
+        upstream_filter=lambda item:True,
+        downstream_filter=is_anonymous)
+
+    tributary_items = [item_by_id[i] for i in tributary_ids]
+    return name, code_carth, main_items, tributary_items
+
+def is_anonymous(item):
+    return (
+        (not item['properties'].get("CODE_CARTH"))
+        and
+        (not item['properties'].get("NOM_C_EAU")))
+
+def select_river_main_items(matched_ids, item_by_id, ids_by_xy):
+    """Return the name, code, main troncons and their ids of the river of
+    the matched troncons."""
+    name = most_frequent([
+        item_by_id[i]['properties'].get("NOM_C_EAU")
+        for i in matched_ids
+        if item_by_id[i]['properties'].get("NOM_C_EAU")
+    ]) or "?"
+    code_carth = most_frequent([
+        item_by_id[i]['properties'].get("CODE_CARTH")
+        for i in matched_ids
+        if item_by_id[i]['properties'].get("CODE_CARTH")
+    ]) or "________"
+    if VERBOSE: sys.stderr.write(code_carth + ": " + name  + "\n")
+
+    if VERBOSE: sys.stderr.write("search main\n")
+    main_ids = get_connected_ids(
+        root_ids=matched_ids,
+        item_by_id=item_by_id,
+        ids_by_xy=ids_by_xy,
+        upstream_filter=is_anonymous,
+        downstream_filter=is_anonymous)
+
+    main_items = [item_by_id[i] for i in main_ids]
+    return name, code_carth, main_items, main_ids
+
+class SqliteTroncons(object):
+    """Troncons stored in a SQLite database by import_troncons_sqlite(),
+    accessed like a fiona collection (item_by_id) with an ids_by_xy
+    mapping answered by the R*Tree index of the endpoints."""
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.proj4 = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'proj4'").fetchone()[0]
+        self.ids_by_xy = SqliteEndpoints(self.connection)
+        self.items_cache = {}
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.connection.close()
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM troncon").fetchone()[0]
+    def __getitem__(self, fid):
+        item = self.items_cache.get(fid)
+        if item is None:
+            row = self.connection.execute(
+                "SELECT properties, coordinates FROM troncon WHERE fid = ?", (fid,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(fid)
+            item = self.items_cache[fid] = self.make_item(*row)
+        return item
+    def __iter__(self):
+        for fid, item in self.items():
+            yield item
+    def items(self):
+        for fid, properties, coordinates in self.connection.execute(
+                "SELECT fid, properties, coordinates FROM troncon ORDER BY fid"):
+            yield fid, self.make_item(properties, coordinates)
+    def make_item(self, properties, coordinates):
+        return {
+            'properties': json.loads(properties),
+            'geometry': {'type': "LineString", 'coordinates': json.loads(coordinates)}}
+    def shp_identity(self):
+        """Return the shp_identity() of the imported shapefile, None if
+        unknown."""
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'shp'").fetchone()
+        return json.loads(row[0]) if row else None
+    def has_catchments(self):
+        return self.connection.execute(
+            "SELECT count(*) FROM sqlite_master WHERE name = 'catchment'").fetchone()[0] > 0
+    def upstream_ids(self, fids, min_order=0):
+        """Return the troncons upstream of the most downstream of the
+        given troncons, with a Strahler order >= min_order."""
+        fids = set(fids)
+        # the catchments of the outlets hold the ones of the other troncons
+        outlets = [(first, last) for fid, parent, first, last in self.connection.execute(
+            "SELECT fid, parent, first, last FROM catchment"
+            " WHERE fid IN (SELECT value FROM json_each(?))", (json.dumps(sorted(fids)),))
+            if parent not in fids]
+        result = set()
+        for first, last in outlets:
+            result.update(i for (i,) in self.connection.execute(
+                "SELECT fid FROM catchment WHERE first BETWEEN ? AND ? AND strahler >= ?",
+                (first, last, min_order)))
+        return result
+    def search(self, search):
+        return [fid for (fid,) in self.connection.execute(
+            "SELECT fid FROM troncon WHERE code_carth = ?"
+            " UNION SELECT fid FROM troncon WHERE nom_norm IN"
+            " (SELECT nom_norm FROM nom WHERE instr(nom_norm, ?) > 0)",
+            (search, strip_accents(search).lower()))]
+
+class SqliteEndpoints(object):
+    def __init__(self, connection):
+        self.connection = connection
+    def __getitem__(self, xy):
+        x, y = xy
+        # the R*Tree stores rounded (outward) 32 bits boxes, check exact coordinates
+        return set(fid for (fid,) in self.connection.execute(
+            "SELECT t.fid FROM endpoint e JOIN troncon t ON t.fid = e.id >> 1"
+            " WHERE e.minx <= ?1 AND e.maxx >= ?1 AND e.miny <= ?2 AND e.maxy >= ?2"
+            " AND ((e.id & 1 = 0 AND t.x1 = ?1 AND t.y1 = ?2)"
+            "   OR (e.id & 1 = 1 AND t.x2 = ?1 AND t.y2 = ?2))",
+            (x, y)))
+
+def import_troncons_sqlite(shp_path, db_path):
+    """Copy the troncons of the shapefile in an indexed SQLite database."""
+    import fiona.crs
+    if VERBOSE:
+        sys.stderr.write("import {0} into {1}\n".format(shp_path, db_path))
+    with fiona.open(shp_path) as shp:
+        write_troncons_sqlite(db_path, fiona.crs.to_string(shp.crs), shp_identity(shp_path),
+                              len(shp), shp.items())
+
+def write_troncons_sqlite(db_path, proj4, identity, size, items):
+    """Write the (index, item) troncons in an indexed SQLite database,
+    renamed to db_path once complete."""
+    if os.path.exists(db_path + ".tmp"):
+        os.remove(db_path + ".tmp")
+    connection = sqlite3.connect(db_path + ".tmp")
+    connection.executescript("""
+        CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE troncon(
+            fid INTEGER PRIMARY KEY,
+            id TEXT, code_carth TEXT, nom_norm TEXT,
+            x1 REAL, y1 REAL, x2 REAL, y2 REAL,
+            properties TEXT, coordinates TEXT);
+        CREATE TABLE nom(nom_norm TEXT PRIMARY KEY);
+        CREATE VIRTUAL TABLE endpoint USING rtree(id, minx, maxx, miny, maxy);
+    """)
+    connection.execute("INSERT INTO meta VALUES ('proj4', ?)", (proj4,))
+    connection.execute("INSERT INTO meta VALUES ('shp', ?)", (json.dumps(identity),))
+    percent = -1
+    for i, item in items:
+        new_percent = int(100*(i+1)/size)
+        if VERBOSE and new_percent > percent:
+            percent = new_percent
+            sys.stderr.write("{0} % ({1} / {2})\r".format(percent, i, size))
+        if item['geometry']['type'] != "LineString":
+            continue
+        properties = dict(item['properties'])
+        coordinates = [list(c) for c in item["geometry"]["coordinates"]]
+        x1, y1 = coordinates[0][:2]
+        x2, y2 = coordinates[-1][:2]
+        nom_norm = None
+        if properties.get("NOM_C_EAU"):
+            nom_norm = strip_accents(properties["NOM_C_EAU"]).lower()
+            connection.execute("INSERT OR IGNORE INTO nom VALUES (?)", (nom_norm,))
+        connection.execute(
+            "INSERT INTO troncon VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (i, properties.get("ID"), properties.get("CODE_CARTH"), nom_norm,
+             x1, y1, x2, y2, json.dumps(properties), json.dumps(coordinates)))
+        connection.executemany(
+            "INSERT INTO endpoint VALUES (?,?,?,?,?)",
+            [(2*i, x1, x1, y1, y1), (2*i+1, x2, x2, y2, y2)])
+    if VERBOSE: sys.stderr.write("\n")
+    connection.executescript("""
+        CREATE INDEX troncon_id ON troncon(id);
+        CREATE INDEX troncon_code_carth ON troncon(code_carth);
+        CREATE INDEX troncon_nom_norm ON troncon(nom_norm);
+    """)
+    connection.commit()
+    connection.close()
+    os.rename(db_path + ".tmp", db_path)
+
+def build_catchments(db_path):
+    """Precompute the upstream catchment of every troncon of the database.
+
+    The troncons are oriented by their geometry and SENS_ECOUL, and each one
+    is linked to one downstream troncon (preferably of the same watercourse)
+    giving a drainage forest. A depth-first numbering of this forest labels
+    each troncon with the interval [first, last] holding the numbers of its
+    whole upstream catchment, stored with its Strahler order and the
+    cumulative length of the catchment.
+    """
+    if VERBOSE:
+        sys.stderr.write("build catchments of {0}\n".format(db_path))
+    connection = sqlite3.connect(db_path)
+    fids = []
+    upstream_xy = {}
+    downstream_xy = {}
+    code_by_fid = {}
+    length_by_fid = {}
+    fids_by_upstream_xy = collections.defaultdict(list)
+    for fid, properties, coordinates in connection.execute(
+            "SELECT fid, properties, coordinates FROM troncon ORDER BY fid"):
+        properties = json.loads(properties)
+        coordinates = json.loads(coordinates)
+        start, end = tuple(coordinates[0][:2]), tuple(coordinates[-1][:2])
+        if properties.get("SENS_ECOUL") == "Sens inverse":
+            start, end = end, start
+        fids.append(fid)
+        upstream_xy[fid] = start
+        downstream_xy[fid] = end
+        code_by_fid[fid] = properties.get("CODE_CARTH")
+        length_by_fid[fid] = sum(
+            math.hypot(x2 - x1, y2 - y1)
+            for (x1, y1), (x2, y2) in zip(
+                [c[:2] for c in coordinates[:-1]], [c[:2] for c in coordinates[1:]]))
+        fids_by_upstream_xy[start].append(fid)
+
+    parent_by_fid = {}
+    children_by_fid = collections.defaultdict(list)
+    for fid in fids:
+        candidates = [i for i in fids_by_upstream_xy.get(downstream_xy[fid], ()) if i != fid]
+        same_code = [i for i in candidates if code_by_fid[fid] and code_by_fid[i] == code_by_fid[fid]]
+        parent = (same_code or candidates or [None])[0]
+        parent_by_fid[fid] = parent
+        if parent is not None:
+            children_by_fid[parent].append(fid)
+
+    first_by_fid = {}
+    last_by_fid = {}
+    strahler_by_fid = {}
+    upstream_length_by_fid = {}
+    counter = 0
+    roots = [fid for fid in fids if parent_by_fid[fid] is None]
+    # troncons in a flow loop are not reachable from an outlet, break the
+    # loop by taking one of them as root
+    for root in itertools.chain(roots, fids):
+        if root in first_by_fid:
+            continue
+        parent_by_fid[root] = None
+        stack = [(root, False)]
+        while stack:
+            fid, done = stack.pop()
+            if not done:
+                first_by_fid[fid] = counter
+                counter += 1
+                stack.append((fid, True))
+                for child in children_by_fid.get(fid, ()):
+                    if child not in first_by_fid:
+                        stack.append((child, False))
+            else:
+                children = [c for c in children_by_fid.get(fid, ())
+                            if parent_by_fid[c] == fid and c in strahler_by_fid
+                            and first_by_fid[c] > first_by_fid[fid]]
+                last_by_fid[fid] = max([last_by_fid[c] for c in children] + [first_by_fid[fid]])
+                orders = sorted((strahler_by_fid[c] for c in children), reverse=True)
+                if not orders:
+                    strahler_by_fid[fid] = 1
+                elif len(orders) > 1 and orders[0] == orders[1]:
+                    strahler_by_fid[fid] = orders[0] + 1
+                else:
+                    strahler_by_fid[fid] = orders[0]
+                upstream_length_by_fid[fid] = length_by_fid[fid] + sum(
+                    upstream_length_by_fid[c] for c in children)
+
+    connection.executescript("""
+        DROP TABLE IF EXISTS catchment;
+        -- not used, built by previous versions
+        DROP TABLE IF EXISTS watercourse;
+        CREATE TABLE catchment(
+            fid INTEGER PRIMARY KEY, parent INTEGER,
+            first INTEGER, last INTEGER,
+            strahler INTEGER, upstream_length REAL);
+    """)
+    connection.executemany(
+        "INSERT INTO catchment VALUES (?,?,?,?,?,?)",
+        ((fid, parent_by_fid[fid], first_by_fid[fid], last_by_fid[fid],
+          strahler_by_fid[fid], upstream_length_by_fid[fid]) for fid in fids))
+    connection.execute("CREATE INDEX catchment_first ON catchment(first)")
+    connection.commit()
+    connection.close()
+
+def build_departements_catalogue(pattern, catalogue_path):
+    """List in a catalogue the per departement TRONCON_HYDROGRAPHIQUE
+    layers matching pattern (a glob or a directory searched recursively),
+    with their extent and the codes and normalized names of their
+    watercourses. The entries of unchanged layers are reused."""
+    import fiona.crs
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "**", "TRONCON_HYDROGRAPHIQUE.shp")
+    previous_catalogue = None
+    previous_layers = {}
+    if os.path.exists(catalogue_path):
+        with open(catalogue_path, encoding="utf-8") as f:
+            previous_catalogue = json.load(f)
+        previous_layers = {layer["path"]: layer for layer in previous_catalogue["layers"]}
+    paths = set()
+    for path in glob.glob(pattern, recursive=True):
+        # a glob matching the departement directories
+        if os.path.isdir(path):
+            paths.update(os.path.abspath(p) for p in glob.glob(
+                os.path.join(path, "**", "TRONCON_HYDROGRAPHIQUE.shp"), recursive=True))
+        else:
+            # the catalogue is usable from any directory
+            paths.add(os.path.abspath(path))
+    catalogue = {"proj4": None, "layers": []}
+    for path in sorted(paths):
+        identity = shp_identity(path)
+        layer = previous_layers.get(path)
+        if layer is None or layer["identity"] != identity:
+            if VERBOSE:
+                sys.stderr.write("catalogue {0}\n".format(path))
+            codes = set()
+            names = set()
+            with fiona.open(path) as shp:
+                catalogue["proj4"] = fiona.crs.to_string(shp.crs)
+                bounds = list(shp.bounds)
+                for item in shp:
+                    properties = item['properties']
+                    if properties.get("CODE_CARTH"):
+                        codes.add(properties["CODE_CARTH"])
+                    if properties.get("NOM_C_EAU"):
+                        names.add(strip_accents(properties["NOM_C_EAU"]).lower())
+            layer = {"path": path, "identity": identity, "bounds": bounds,
+                     "codes": sorted(codes), "names": sorted(names)}
+        catalogue["layers"].append(layer)
+    if not catalogue["layers"]:
+        raise Exception("no TRONCON_HYDROGRAPHIQUE layer matching " + pattern)
+    if catalogue["proj4"] is None:
+        if previous_catalogue is not None:
+            catalogue["proj4"] = previous_catalogue["proj4"]
+        else:
+            with fiona.open(catalogue["layers"][0]["path"]) as shp:
+                catalogue["proj4"] = fiona.crs.to_string(shp.crs)
+    # an unchanged catalogue keeps its identity, used by the manifests and
+    # the result cache
+    if catalogue == previous_catalogue:
+        return
+    with open(catalogue_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(catalogue, f)
+    os.replace(catalogue_path + ".tmp", catalogue_path)
+
+class DepartementLayers(object):
+    """Per departement troncon layers listed in a catalogue, accessed like a
+    fiona collection (item_by_id) keyed by (layer number, feature index).
+
+    Only the layers holding searched watercourses are read first. The
+    ids_by_xy mapping reads the neighbour layers when the traversal reaches
+    a point of their extent, so that the networks are stitched across the
+    departement borders through their shared endpoints. Troncons delivered
+    in several departements are kept once, by their ID.
+    """
+    def __init__(self, catalogue_path):
+        with open(catalogue_path, encoding="utf-8") as f:
+            catalogue = json.load(f)
+        self.proj4 = catalogue["proj4"]
+        self.layers = catalogue["layers"]
+        self.collections = {}
+        self.loaded_troncon_ids = set()
+        self.ids_by_xy = DepartementEndpoints(self)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        for collection in self.collections.values():
+            collection.close()
+        self.collections = {}
+    def __getitem__(self, key):
+        n, i = key
+        return self.collection(n)[i]
+    def __iter__(self):
+        troncon_ids = set()
+        for n in range(len(self.layers)):
+            for item in self.collection(n):
+                troncon_id = item['properties'].get("ID")
+                if troncon_id:
+                    if troncon_id in troncon_ids:
+                        continue
+                    troncon_ids.add(troncon_id)
+                yield item
+    def collection(self, n):
+        import fiona
+        if n not in self.collections:
+            self.collections[n] = fiona.open(self.layers[n]["path"])
+        return self.collections[n]
+    def search(self, search):
+        """Read the layers holding the searched watercourse, return the
+        matched troncons."""
+        normalized_search = strip_accents(search).lower()
+        matched_ids = []
+        for n, layer in enumerate(self.layers):
+            if (search in layer["codes"]
+                    or any(name.find(normalized_search) >= 0 for name in layer["names"])):
+                matched_ids.extend(self.load_layer(n, search))
+        return matched_ids
+    def load_layer(self, n, search=None):
+        """Index the endpoints of the troncons of a layer, return the ones
+        matching search."""
+        if VERBOSE:
+            sys.stderr.write("read {0}\n".format(self.layers[n]["path"]))
+        self.ids_by_xy.loaded_layers.add(n)
+        matched_ids = []
+        for i, item in self.collection(n).items():
+            troncon_id = item['properties'].get("ID")
+            if troncon_id:
+                if troncon_id in self.loaded_troncon_ids:
+                    continue
+                self.loaded_troncon_ids.add(troncon_id)
+            if search is not None and matches_search(item['properties'], search):
+                matched_ids.append((n, i))
+            if item['geometry']['type'] == "LineString":
+                coordinates = item["geometry"]["coordinates"]
+                x1,y1,z1 = coordinates[0]
+                x2,y2,z2 = coordinates[-1]
+                self.ids_by_xy.ids_by_xy[(x1,y1)].add((n, i))
+                self.ids_by_xy.ids_by_xy[(x2,y2)].add((n, i))
+        return matched_ids
+
+class DepartementEndpoints(object):
+    def __init__(self, layers):
+        self.layers = layers
+        self.loaded_layers = set()
+        self.ids_by_xy = collections.defaultdict(set)
+    def __getitem__(self, xy):
+        x, y = xy
+        for n, layer in enumerate(self.layers.layers):
+            if n not in self.loaded_layers:
+                minx, miny, maxx, maxy = layer["bounds"]
+                if minx <= x <= maxx and miny <= y <= maxy:
+                    self.layers.load_layer(n)
+        return self.ids_by_xy.get(xy, ())
+
+def extract_troncons_departements(catalogue_path, search):
+    with DepartementLayers(catalogue_path) as layers:
+        matched_ids = layers.search(search)
+        name, code_carth, main_items, tributary_items = \
+            select_river_items(matched_ids, layers, layers.ids_by_xy)
+    return layers.proj4, name, code_carth, main_items, tributary_items
+
+def open_troncons(path):
+    """Open the troncons of a shapefile, of a SQLite database or of a
+    catalogue of departement layers."""
+    if path.endswith(".sqlite"):
+        return SqliteTroncons(path)
+    if path.endswith(".json"):
+        return DepartementLayers(path)
+    import fiona
+    return fiona.open(path)
+
+def get_troncons_proj4(troncons):
+    if isinstance(troncons, (SqliteTroncons, DepartementLayers)):
+        return troncons.proj4
+    import fiona.crs
+    return fiona.crs.to_string(troncons.crs)
+
+def matches_search(properties, search):
+    return ((search == properties.get("CODE_CARTH"))
+            or
+            (strip_accents(properties.get("NOM_C_EAU") or "").lower().find(strip_accents(search).lower()) >= 0))
+
 def strip_accents(s):
    return ''.join(c for c in unicodedata.normalize('NFD', s)
                   if unicodedata.category(c) != 'Mn')
 
-def save_items_as_osm(items, transformation, filename):
+def save_items_as_osm(items, transformation, filename, node_id_by_coord=None, way_ids=None):
     if VERBOSE: sys.stderr.write("save {0}\n".format(filename))
-    with (gzip.open(filename, "wt", encoding="utf-8") if filename.endswith(".gz")
-          else open(filename, "w", encoding="utf-8")) \
-    as f:
-        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        f.write('<osm version="0.6" upload="false" generator="{0}">\n'.format(os.path.basename(sys.argv[0])))
-        min_id = 0
+    with osm.atomic_open(filename) as f:
+        return write_items_as_osm(items, transformation, f, node_id_by_coord, way_ids)
+
+def write_items_as_osm(items, transformation, f, node_id_by_coord=None, way_ids=None):
+    """Write the items as OSM ways. node_id_by_coord and way_ids may give
+    the ids of the nodes and ways, by default new negative ids are used.
+    Return the bbox of the written nodes."""
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write('<osm version="0.6" upload="false" generator="{0}">\n'.format(os.path.basename(sys.argv[0])))
+    min_id = 0
+    if node_id_by_coord is None:
         node_id_by_coord = {}
-        for item in items:
-            assert(item['geometry']['type'] == "LineString")
-            coordinates = item["geometry"]["coordinates"]
-            for j,(x,y,z) in enumerate(coordinates):
-                if (x,y) not in node_id_by_coord:
-                    lon, lat, ele = transformation.TransformPoint(x,y,z)
+    written_coords = set()
+    bbox = geometry.BBox()
+    for item in items:
+        assert(item['geometry']['type'] == "LineString")
+        coordinates = item["geometry"]["coordinates"]
+        for j,(x,y,z) in enumerate(coordinates):
+            if (x,y) not in written_coords:
+                written_coords.add((x,y))
+                lon, lat, ele = transformation.TransformPoint(x,y,z)
+                bbox.extend(lon, lat)
+                node_id = node_id_by_coord.get((x,y))
+                if node_id is None:
                     min_id = min_id - 1
-                    node_id_by_coord[(x,y)] = min_id
-                    if (j==0 or j==(len(coordinates)-1)) and ele >=0 and ele < 5000:
-                        f.write('\t<node lon="{0}" lat="{1}" id="{2}">\n'.format(lon,lat,min_id))
-                        f.write('\t\t<tag k="ele" v="{0}"/>\n'.format(ele))
-                        f.write('\t</node>')
-                    else:
-                        f.write('\t<node lon="{0}" lat="{1}" id="{2}"/>\n'.format(lon,lat,min_id))
-        for item in items:
+                    node_id = node_id_by_coord[(x,y)] = min_id
+                if (j==0 or j==(len(coordinates)-1)) and ele >=0 and ele < 5000:
+                    f.write('\t<node lon="{0}" lat="{1}" id="{2}">\n'.format(lon,lat,node_id))
+                    f.write('\t\t<tag k="ele" v="{0}"/>\n'.format(ele))
+                    f.write('\t</node>')
+                else:
+                    f.write('\t<node lon="{0}" lat="{1}" id="{2}"/>\n'.format(lon,lat,node_id))
+    for i, item in enumerate(items):
+        if way_ids is None:
             min_id = min_id - 1
-            f.write('\t<way id="{0}">\n'.format(min_id))
-            for x,y,z in item["geometry"]["coordinates"]:
-                nd_id = node_id_by_coord[(x,y)]
-                f.write('\t\t<nd ref="{0}"/>\n'.format(nd_id))
-            for k,v in item['properties'].items():
-                if v:
-                    f.write('\t\t<tag k={0} v={1}/>\n'.format(
-                        xml.sax.saxutils.quoteattr(k),
-                        xml.sax.saxutils.quoteattr(str(v))))
-            f.write('\t</way>\n')
-        f.write('</osm>\n')
+            way_id = min_id
+        else:
+            way_id = way_ids[i]
+        f.write('\t<way id="{0}">\n'.format(way_id))
+        for x,y,z in item["geometry"]["coordinates"]:
+            nd_id = node_id_by_coord[(x,y)]
+            f.write('\t\t<nd ref="{0}"/>\n'.format(nd_id))
+        for k,v in item['properties'].items():
+            if v:
+                f.write('\t\t<tag k={0} v={1}/>\n'.format(
+                    osm.quoteattr(k), osm.quoteattr(str(v))))
+        f.write('\t</way>\n')
+    f.write('</osm>\n')
+    return bbox.bbox()
+
+def save_items_as_osm_chunks(items, transformation, filename, tile_size=None, max_nodes=None):
+    """Save the items in several files grouped by tiles of tile_size degrees
+    and/or in chunks of at most max_nodes nodes (see geometry.chunk_indexes),
+    listed with their bbox in an index file. Only the ids of the troncon
+    endpoints are kept in memory, the nodes shared by several files have the
+    same id in each of them. Return the list of the written files, index first.
+    """
+    node_id_by_endpoint = {}
+    for item in items:
+        coordinates = item["geometry"]["coordinates"]
+        for x,y,z in (coordinates[0], coordinates[-1]):
+            if (x,y) not in node_id_by_endpoint:
+                node_id_by_endpoint[(x,y)] = -1 - len(node_id_by_endpoint)
+    # the other nodes are numbered after the endpoints, troncon by troncon
+    min_id = -len(node_id_by_endpoint)
+    first_node_ids = []
+    for item in items:
+        first_node_ids.append(min_id - 1)
+        min_id -= len(item["geometry"]["coordinates"])
+    first_way_id = min_id - 1
+    groups = geometry.chunk_indexes(
+        [transformation.TransformPoint(*item["geometry"]["coordinates"][0])[:2]
+         for item in items],
+        [len(item["geometry"]["coordinates"]) for item in items],
+        tile_size, max_nodes)
+    entries = []
+    filenames = []
+    for number, group in enumerate(groups):
+        node_id_by_coord = {}
+        for i in group:
+            for j,(x,y,z) in enumerate(items[i]["geometry"]["coordinates"]):
+                if (x,y) not in node_id_by_coord:
+                    node_id_by_coord[(x,y)] = node_id_by_endpoint.get((x,y), first_node_ids[i] - j)
+        chunk_filename = osm.chunk_filename(filename, number + 1)
+        bbox = save_items_as_osm(
+            [items[i] for i in group], transformation, chunk_filename,
+            node_id_by_coord, [first_way_id - i for i in group])
+        entries.append({
+            "file": os.path.basename(chunk_filename),
+            "bbox": bbox,
+            "nodes": len(node_id_by_coord),
+            "ways": len(group)})
+        filenames.append(chunk_filename)
+    return [osm.write_chunks_index(filename, entries)] + filenames
+
+def simplify_items(items, tolerance):
+    """Return copies of the items with their troncons simplified, keeping
+    their endpoints and the vertices shared with other troncons."""
+    use_count = collections.Counter(
+        (x,y) for item in items for x,y,z in item["geometry"]["coordinates"])
+    result = []
+    vertices_before = 0
+    vertices_after = 0
+    for item in items:
+        coordinates = item["geometry"]["coordinates"]
+        kept = geometry.simplify(
+            [c[0] for c in coordinates],
+            [c[1] for c in coordinates],
+            tolerance,
+            keep=[j for j, c in enumerate(coordinates) if use_count[(c[0], c[1])] > 1])
+        vertices_before += len(coordinates)
+        vertices_after += len(kept)
+        result.append({
+            'properties': item['properties'],
+            'geometry': {'type': "LineString",
+                         'coordinates': [coordinates[j] for j in kept]}})
+    if VERBOSE and vertices_before:
+        sys.stderr.write("simplify: {0} -> {1} vertices (-{2:.0f} %)\n".format(
+            vertices_before, vertices_after,
+            100.0 * (vertices_before - vertices_after) / vertices_before))
+    return result
+
+def get_surfaces_path(troncons_path):
+    """SURFACE_HYDROGRAPHIQUE layer of the BD Topo delivery of the troncons."""
+    return os.path.join(os.path.dirname(troncons_path), "SURFACE_HYDROGRAPHIQUE.shp")
+
+def get_polygons(geometry_dict):
+    """Return the list of the polygons (lists of rings) of a geometry."""
+    if geometry_dict['type'] == "Polygon":
+        return [geometry_dict['coordinates']]
+    if geometry_dict['type'] == "MultiPolygon":
+        return geometry_dict['coordinates']
+    return []
+
+class SurfaceIndex(object):
+    """Water surfaces indexed by their ID and by an STR-tree of their bbox."""
+    def __init__(self, surfaces):
+        self.surfaces = [s for s in surfaces if s['geometry'] and get_polygons(s['geometry'])]
+        self.index_by_id = {}
+        bboxes = []
+        for i, surface in enumerate(self.surfaces):
+            surface_id = surface['properties'].get("ID")
+            if surface_id:
+                self.index_by_id[surface_id] = i
+            bbox = geometry.BBox()
+            for polygon in get_polygons(surface['geometry']):
+                bbox.extend_all([c[0] for c in polygon[0]], [c[1] for c in polygon[0]])
+            bboxes.append(bbox.bbox())
+        self.tree = geometry.STRtree(bboxes)
+    def linked_indexes(self, items):
+        """Surfaces referenced by the ID_S_HYDRO of the troncons."""
+        result = set()
+        for item in items:
+            for surface_id in str(item['properties'].get("ID_S_HYDRO") or "").split("/"):
+                if surface_id.strip() in self.index_by_id:
+                    result.add(self.index_by_id[surface_id.strip()])
+        return result
+    def intersecting_indexes(self, items):
+        """Surfaces intersecting the troncons: containing one of their
+        vertices or crossed by one of their segments."""
+        result = set()
+        for item in items:
+            coordinates = item["geometry"]["coordinates"]
+            # a single point is a segment of null length
+            for c1, c2 in zip(coordinates, coordinates[1:] or coordinates):
+                x1, y1, x2, y2 = c1[0], c1[1], c2[0], c2[1]
+                segment_bbox = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+                for i in self.tree.query(segment_bbox):
+                    if i not in result and any(
+                            geometry.segment_intersects_polygon(polygon, x1, y1, x2, y2)
+                            for polygon in get_polygons(self.surfaces[i]['geometry'])):
+                        result.add(i)
+        return result
+    def select(self, items):
+        indexes = self.linked_indexes(items) | self.intersecting_indexes(items)
+        return [self.surfaces[i] for i in sorted(indexes)]
+
+def extract_surfaces(surfaces_path, items):
+    """Return the water surfaces linked to or intersecting the troncons. Only
+    the surfaces of the bbox of the troncons are read and indexed."""
+    import fiona
+    bbox = geometry.BBox()
+    for item in items:
+        coordinates = item["geometry"]["coordinates"]
+        bbox.extend_all([c[0] for c in coordinates], [c[1] for c in coordinates])
+    if bbox.bbox() is None:
+        return []
+    if VERBOSE: sys.stderr.write("read {0}\n".format(surfaces_path))
+    with fiona.open(surfaces_path) as layer:
+        index = SurfaceIndex(list(layer.filter(bbox=bbox.bbox())))
+    return index.select(items)
+
+def save_surfaces_as_osm(surfaces, transformation, filename):
+    """Save the surfaces as closed ways, or as multipolygon relations when
+    they have holes or several parts."""
+    osm_data = osm.Osm({"upload": "false"})
+    node_by_coord = {}
+    ids = itertools.count(-1, -1)
+    def create_ring_way(ring, tags=None):
+        way = osm_data.create_way({"id": str(next(ids))}, tags)
+        for c in ring:
+            node = node_by_coord.get((c[0], c[1]))
+            if node is None:
+                lon, lat, ele = transformation.TransformPoint(c[0], c[1], 0.0)
+                node = node_by_coord[(c[0], c[1])] = osm_data.create_node(
+                    {"id": str(next(ids)), "lon": str(lon), "lat": str(lat)})
+            way.add_node(node)
+        return way
+    for surface in surfaces:
+        tags = {k: str(v) for k, v in surface['properties'].items() if v}
+        polygons = get_polygons(surface['geometry'])
+        if len(polygons) == 1 and len(polygons[0]) == 1:
+            create_ring_way(polygons[0][0], tags)
+        else:
+            relation = osm_data.create_relation(
+                {"id": str(next(ids))}, dict(tags, type="multipolygon"))
+            for polygon in polygons:
+                for j, ring in enumerate(polygon):
+                    relation.add_member(create_ring_way(ring), "outer" if j == 0 else "inner")
+    if VERBOSE: sys.stderr.write("save {0}\n".format(filename))
+    with osm.atomic_open(filename) as f:
+        osm.OsmWriter(osm_data).write_to_stream(f)
 
 def get_proj4_to_osm_transformation(proj4):
+    import osgeo.osr
     src = osgeo.osr.SpatialReference()
     src.ImportFromProj4(proj4)
     dst = osgeo.osr.SpatialReference()
@@ -189,41 +861,658 @@ def most_frequent(List):
         return None
 
 
-def extract_river(shp_path, search):
-    proj4, name, code_carth, main_items, tributary_items = \
-        extract_troncons_shp(shp_path, search)
+def extract_river(shp_path, search, cache=None, options=ExtractOptions()):
+    if cache is not None:
+        key = cache.key(shp_path, search, options)
+        result = cache.get(key)
+        if result is not None:
+            if VERBOSE: sys.stderr.write("cached {0}\n".format(result["tributary"]))
+            return result
+    if shp_path.endswith(".sqlite"):
+        proj4, name, code_carth, main_items, tributary_items = \
+            extract_troncons_sqlite(shp_path, search, options.min_order)
+    elif shp_path.endswith(".json"):
+        proj4, name, code_carth, main_items, tributary_items = \
+            extract_troncons_departements(shp_path, search)
+    else:
+        proj4, name, code_carth, main_items, tributary_items = \
+            extract_troncons_shp(shp_path, search)
     transformation = get_proj4_to_osm_transformation(proj4)
     prefix_filename = code_carth + " - " + name.replace("/","-")
     main_filename = prefix_filename  + " - main.osm.gz"
     tributary_filename = prefix_filename  + " - tributary.osm.gz"
-    save_items_as_osm(main_items, transformation, main_filename)
-    save_items_as_osm(tributary_items, transformation, tributary_filename)
+    files = []
+    for items, filename in ((main_items, main_filename),
+                            (tributary_items, tributary_filename)):
+        if options.simplify:
+            items = simplify_items(items, options.simplify)
+        if options.tile_size or options.max_nodes:
+            files.extend(save_items_as_osm_chunks(
+                items, transformation, filename, options.tile_size, options.max_nodes))
+        else:
+            save_items_as_osm(items, transformation, filename)
+            files.append(filename)
+    if options.tile_size or options.max_nodes:
+        main_filename = osm.index_filename(main_filename)
+        tributary_filename = osm.index_filename(tributary_filename)
+    surfaces_filename = None
+    if options.surfaces:
+        surfaces_filename = prefix_filename + " - surfaces.osm.gz"
+        save_surfaces_as_osm(extract_surfaces(options.surfaces, tributary_items),
+                             transformation, surfaces_filename)
+        files.append(surfaces_filename)
+    endpoints = set()
+    for item in tributary_items:
+        coordinates = item["geometry"]["coordinates"]
+        endpoints.add(tuple(coordinates[0][:2]))
+        endpoints.add(tuple(coordinates[-1][:2]))
+    result = {
+        "name": name,
+        "code_carth": code_carth,
+        "main": main_filename,
+        "tributary": tributary_filename,
+        "surfaces": surfaces_filename,
+        "files": files,
+        "troncons": sorted(item['properties'].get("ID") for item in tributary_items
+                           if item['properties'].get("ID")),
+        "endpoints": sorted(endpoints),
+    }
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+class ResultCache(object):
+    """Cache of extract_river() results shared by several processes.
+
+    Each entry is a directory named after the hash of its key, holding the
+    result description and its output files. Entries are built in a
+    temporary directory then renamed, so a reader never sees a partial
+    entry. The modification time of an entry is its last use, the least
+    recently used entries are removed when the cache exceeds max_size bytes.
+    A shared lock is held while reading or adding entries and an exclusive
+    one while evicting them.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.lock_filename = os.path.join(directory, "lock")
+    def key(self, shp_path, search, options=ExtractOptions()):
+        # normalized as in matches_search(), spaces are significant
+        normalized_search = strip_accents(search).lower()
+        # Carthage codes are matched exactly, not normalized
+        code = search if re.match("^[A-Z0-9-]{8}$", search) else None
+        surfaces_identity = shp_identity(options.surfaces) if options.surfaces else None
+        return hashlib.sha256(json.dumps(
+            [RESULT_VERSION, shp_identity(shp_path), normalized_search, code, list(options),
+             surfaces_identity]
+        ).encode("utf-8")).hexdigest()
+    def lock(self, operation):
+        f = open(self.lock_filename, "a")
+        fcntl.flock(f, operation)
+        return f
+    def get(self, key):
+        entry = os.path.join(self.directory, key)
+        with self.lock(fcntl.LOCK_SH):
+            try:
+                with open(os.path.join(entry, "result.json"), encoding="utf-8") as f:
+                    result = json.load(f)
+                for number, filename in enumerate(result["files"]):
+                    shutil.copyfile(os.path.join(entry, str(number)), filename + ".tmp")
+                    os.replace(filename + ".tmp", filename)
+                os.utime(entry)
+            except FileNotFoundError:
+                return None
+        return result
+    def put(self, key, result):
+        entry = os.path.join(self.directory, key)
+        with self.lock(fcntl.LOCK_SH):
+            tmp = tempfile.mkdtemp(prefix="tmp-", dir=self.directory)
+            try:
+                for number, filename in enumerate(result["files"]):
+                    shutil.copyfile(filename, os.path.join(tmp, str(number)))
+                with open(os.path.join(tmp, "result.json"), "w", encoding="utf-8") as f:
+                    json.dump(result, f)
+                os.rename(tmp, entry)
+            except OSError:
+                # another process added the same entry first
+                pass
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+    def evict(self):
+        with self.lock(fcntl.LOCK_EX):
+            entries = []
+            total_size = 0
+            for name in os.listdir(self.directory):
+                entry = os.path.join(self.directory, name)
+                if name.startswith("tmp-") or not os.path.isdir(entry):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                           for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+                total_size += size
+            entries.sort()
+            while total_size > self.max_size and entries:
+                mtime, size, entry = entries.pop(0)
+                if VERBOSE: sys.stderr.write("evict {0}\n".format(entry))
+                shutil.rmtree(entry, ignore_errors=True)
+                total_size -= size
+
+
+def shp_identity(shp_path):
+    """Identify a shapefile edition by its path, size and modification time."""
+    identity = [os.path.realpath(shp_path)]
+    for path in (shp_path, os.path.splitext(shp_path)[0] + ".dbf"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            identity.extend([stat.st_size, stat.st_mtime_ns])
+    return identity
+
+
+def scan_troncons_changes(shp_path, previous_dates, collect_changes=True):
+    """Read the ID and DATE_MAJ of every troncon of the shapefile.
+
+    Return the new dates by ID, the IDs that are new, modified or removed
+    compared to previous_dates, and for the new or modified troncons their
+    endpoints, codes and normalized names (needed to find the rivers they
+    may join). Without collect_changes, only the dates are read.
+    """
+    dates = {}
+    changed_ids = set()
+    changed_xys = set()
+    changed_codes = set()
+    changed_names = set()
+    if VERBOSE:
+        sys.stderr.write("scan {0}\n".format(shp_path))
+    with open_troncons(shp_path) as shp:
+        for item in shp:
+            properties = item['properties']
+            troncon_id = properties.get("ID")
+            if not troncon_id:
+                continue
+            date = properties.get("DATE_MAJ") or properties.get("DATE_CREAT") or ""
+            dates[troncon_id] = str(date)
+            if collect_changes and previous_dates.get(troncon_id) != dates[troncon_id]:
+                changed_ids.add(troncon_id)
+                if properties.get("CODE_CARTH"):
+                    changed_codes.add(properties["CODE_CARTH"])
+                if properties.get("NOM_C_EAU"):
+                    changed_names.add(strip_accents(properties["NOM_C_EAU"]).lower())
+                if item['geometry']['type'] == "LineString":
+                    coordinates = item["geometry"]["coordinates"]
+                    changed_xys.add(tuple(coordinates[0][:2]))
+                    changed_xys.add(tuple(coordinates[-1][:2]))
+    if collect_changes:
+        changed_ids.update(set(previous_dates) - set(dates))
+    return dates, changed_ids, changed_xys, changed_codes, changed_names
+
+
+def get_affected_searches(manifest, changed_ids, changed_xys, changed_codes, changed_names):
+    """Return the searches of the manifest whose river may have changed."""
+    affected = []
+    for search, river in manifest["rivers"].items():
+        # same test as matches_search(), the changed names being normalized
+        normalized_search = strip_accents(search).lower()
+        if ((not changed_ids.isdisjoint(river["troncons"]))
+                or (not changed_xys.isdisjoint(map(tuple, river["endpoints"])))
+                or search in changed_codes
+                or any(name.find(normalized_search) >= 0 for name in changed_names)):
+            affected.append(search)
+    return affected
+
+
+def load_manifest(filename):
+    if os.path.exists(filename):
+        with open(filename, encoding="utf-8") as f:
+            return json.load(f)
+    return {"shp": None, "rivers": {}, "pending": []}
+
+
+def save_manifest(manifest, filename):
+    with open(filename + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def get_troncons_filename(manifest_filename):
+    """File of the troncon dates of a manifest: 'a.json' -> 'a.troncons.json'.
 
+    The dates of every troncon of the shapefile are kept apart from the
+    manifest, saved after each river, as they only change with a scan."""
+    return os.path.splitext(manifest_filename)[0] + ".troncons.json"
 
-def get_bd_hydro_troncons_shp():
+
+def load_troncon_dates(manifest, manifest_filename):
+    """Return the troncon dates of the last scan of the manifest."""
+    # manifests of previous versions held the dates
+    dates = manifest.pop("troncons", None)
+    troncons_filename = get_troncons_filename(manifest_filename)
+    if os.path.exists(troncons_filename):
+        with open(troncons_filename, encoding="utf-8") as f:
+            return json.load(f)
+    if dates is None:
+        return {}
+    save_troncon_dates(dates, manifest_filename)
+    return dates
+
+
+def save_troncon_dates(dates, manifest_filename):
+    with osm.atomic_open(get_troncons_filename(manifest_filename)) as f:
+        json.dump(dates, f)
+
+
+def file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def is_river_done(river, options):
+    """Tell if a river of the manifest was extracted with these options and
+    its output files are all there, unchanged."""
+    if river.get("options", {}) != options._asdict() or not river.get("hashes"):
+        return False
+    for filename, sha256 in river["hashes"].items():
+        if not os.path.exists(filename) or file_sha256(filename) != sha256:
+            if VERBOSE: sys.stderr.write("missing or modified {0}\n".format(filename))
+            return False
+    return True
+
+
+def extract_rivers_with_manifest(shp_path, searches, manifest_filename, update,
+                                 cache=None, options=ExtractOptions(), resume=False):
+    """Extract the rivers and record them in the manifest, saved after each
+    river, and the troncon dates, saved once per scan. The searches left
+    by an interrupted run are listed in its "pending" entry. With resume,
+    the rivers already extracted with the same options, whose output files
+    are unchanged, are skipped."""
+    manifest = load_manifest(manifest_filename)
+    manifest.setdefault("pending", [])
+    previous_dates = load_troncon_dates(manifest, manifest_filename)
+    identity = shp_identity(shp_path)
+    new_searches = set(searches)
+    dates = None
+    if update or manifest["shp"] is None:
+        # without previous state, every troncon would be a change
+        dates, changed_ids, changed_xys, changed_codes, changed_names = \
+            scan_troncons_changes(shp_path, previous_dates, update and bool(previous_dates))
+        if update:
+            if previous_dates:
+                affected = get_affected_searches(
+                    manifest, changed_ids, changed_xys, changed_codes, changed_names)
+            else:
+                # the dates of the last scan are lost, the changes are unknown
+                affected = list(manifest["rivers"])
+            if VERBOSE:
+                sys.stderr.write("{0} changed troncons, {1} / {2} rivers to update\n".format(
+                    len(changed_ids), len(affected), len(manifest["rivers"])))
+            # the rivers not updated by an interrupted update
+            affected.extend(s for s in manifest["pending"] if s not in affected)
+            searches = affected + [s for s in searches if s not in affected]
+    elif manifest["shp"] != identity:
+        raise Exception("manifest " + manifest_filename
+                        + " was built from another shapefile, use --update")
+    manifest["shp"] = identity
+    todo = []
+    for search in searches:
+        river_options = options
+        if search in manifest["rivers"] and search not in new_searches:
+            # re-extract the river as it was first extracted
+            river_options = ExtractOptions(**manifest["rivers"][search].get("options", {}))
+        if (resume and search in manifest["rivers"] and search not in manifest["pending"]
+                and is_river_done(manifest["rivers"][search], river_options)):
+            if VERBOSE: sys.stderr.write("done {0}\n".format(search))
+            continue
+        todo.append((search, river_options))
+    manifest["pending"] = [search for search, river_options in todo]
+    save_manifest(manifest, manifest_filename)
+    # after the pending rivers, so that an interrupted update is scanned
+    # again against the previous dates
+    if dates is not None:
+        save_troncon_dates(dates, manifest_filename)
+    for search, river_options in todo:
+        river = extract_river(shp_path, search, cache, river_options)
+        river["options"] = river_options._asdict()
+        river["hashes"] = {filename: file_sha256(filename) for filename in river["files"]}
+        manifest["rivers"][search] = river
+        manifest["pending"].remove(search)
+        save_manifest(manifest, manifest_filename)
+
+
+def get_bd_hydro_troncons_shp(checksum=None, segments=4):
+    """Download and extract the BD Topo Hydrographie archive if needed. The
+    archive is verified with checksum, or else with the checksum published
+    next to it, before its extraction."""
     if not os.path.exists(PATH_SHP):
+        import download
         basename = os.path.basename(URL_HYDRO)
         if not os.path.exists(basename):
-            if VERBOSE:
-                sys.stderr.write("download {0}\n".format(URL_HYDRO))
-            try:
-                urllib.request.urlretrieve (URL_HYDRO, basename + ".tmp")
-                os.rename(basename + ".tmp", basename)
-            finally:
-                urllib.request.urlcleanup()
+            download.download(URL_HYDRO, basename,
+                              checksum or download.get_sidecar_checksum(URL_HYDRO), segments)
         subprocess.check_call(["7z","x", basename])
     return PATH_SHP
 
 
+class Network(object):
+    """All the troncons of a shapefile loaded in memory, with the indexes
+    needed to answer many extractions without reading the shapefile again."""
+    GRID_SIZE = 1000.0 # size in metters of the cells of the endpoint grid
+    def __init__(self, shp_path):
+        self.items = []
+        self.ids_by_xy = collections.defaultdict(set)
+        self.ids_by_code = collections.defaultdict(list)
+        self.ids_by_name = collections.defaultdict(list)
+        self.ids_by_cell = collections.defaultdict(set)
+        if VERBOSE:
+            sys.stderr.write("load {0}\n".format(shp_path))
+        with open_troncons(shp_path) as shp:
+            self.proj4 = get_troncons_proj4(shp)
+            for item in shp:
+                if item['geometry']['type'] != "LineString":
+                    continue
+                i = len(self.items)
+                properties = dict(item['properties'])
+                coordinates = [tuple(c) for c in item["geometry"]["coordinates"]]
+                self.items.append({
+                    'properties': properties,
+                    'geometry': {'type': "LineString", 'coordinates': coordinates}})
+                if properties.get("CODE_CARTH"):
+                    self.ids_by_code[properties["CODE_CARTH"]].append(i)
+                if properties.get("NOM_C_EAU"):
+                    self.ids_by_name[strip_accents(properties["NOM_C_EAU"]).lower()].append(i)
+                for x, y, z in (coordinates[0], coordinates[-1]):
+                    self.ids_by_xy[(x,y)].add(i)
+                    self.ids_by_cell[self.cell(x, y)].add(i)
+        self.local = threading.local()
+        if VERBOSE:
+            sys.stderr.write("{0} troncons loaded\n".format(len(self.items)))
+    def cell(self, x, y):
+        return (int(x // self.GRID_SIZE), int(y // self.GRID_SIZE))
+    def transformations(self):
+        """Return the (to osm, from osm) transformations of the current thread,
+        osr transformations being not thread safe."""
+        if not hasattr(self.local, "transformations"):
+            import osgeo.osr
+            to_osm = get_proj4_to_osm_transformation(self.proj4)
+            src = osgeo.osr.SpatialReference()
+            src.ImportFromEPSG(4326)
+            dst = osgeo.osr.SpatialReference()
+            dst.ImportFromProj4(self.proj4)
+            self.local.transformations = to_osm, osgeo.osr.CoordinateTransformation(src, dst)
+        return self.local.transformations
+    def search(self, search):
+        matched_ids = list(self.ids_by_code.get(search, []))
+        normalized_search = strip_accents(search).lower()
+        for name, ids in self.ids_by_name.items():
+            if name.find(normalized_search) >= 0:
+                matched_ids.extend(ids)
+        return set(matched_ids)
+    def search_bbox(self, bbox):
+        """Return the troncons with an endpoint in the bbox given in WGS84."""
+        minlon, minlat, maxlon, maxlat = bbox
+        from_osm = self.transformations()[1]
+        corners = [from_osm.TransformPoint(lon, lat)[:2]
+                   for lon in (minlon, maxlon) for lat in (minlat, maxlat)]
+        minx = min(x for x, y in corners)
+        miny = min(y for x, y in corners)
+        maxx = max(x for x, y in corners)
+        maxy = max(y for x, y in corners)
+        (mincx, mincy), (maxcx, maxcy) = self.cell(minx, miny), self.cell(maxx, maxy)
+        result = set()
+        for cx in range(mincx, maxcx + 1):
+            for cy in range(mincy, maxcy + 1):
+                for i in self.ids_by_cell.get((cx, cy), ()):
+                    for x, y, z in self.endpoints(i):
+                        if minx <= x <= maxx and miny <= y <= maxy:
+                            result.add(i)
+        return result
+    def search_point(self, lon, lat, max_distance=10000.0):
+        """Return the troncon with the nearest endpoint and the other
+        troncons of the same watercourse."""
+        x, y = self.transformations()[1].TransformPoint(lon, lat)[:2]
+        cx, cy = self.cell(x, y)
+        nearest = None
+        radius = 0
+        while nearest is None and radius * self.GRID_SIZE <= max_distance:
+            for dx in range(-radius, radius + 1):
+                for dy in range(-radius, radius + 1):
+                    if max(abs(dx), abs(dy)) != radius:
+                        continue
+                    for i in self.ids_by_cell.get((cx + dx, cy + dy), ()):
+                        for ex, ey, ez in self.endpoints(i):
+                            d = (ex - x) ** 2 + (ey - y) ** 2
+                            if nearest is None or d < nearest[0]:
+                                nearest = (d, i)
+            radius += 1
+        if nearest is None:
+            return set()
+        i = nearest[1]
+        code_carth = self.items[i]['properties'].get("CODE_CARTH")
+        return set(self.ids_by_code[code_carth]) if code_carth else {i}
+    def endpoints(self, i):
+        coordinates = self.items[i]["geometry"]["coordinates"]
+        return coordinates[0], coordinates[-1]
+    def select_river_items(self, matched_ids):
+        return select_river_items(matched_ids, self.items, self.ids_by_xy)
+
+
+class ExtractionRequestHandlerMixIn(object):
+    """Answer GET /extract?search=...&bbox=...&point=...&part=main|tributary
+    &simplify=... with the .osm.gz of the river."""
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/extract":
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        network = self.server.network
+        try:
+            matched_ids = None
+            if "search" in query:
+                matched_ids = network.search(query["search"][0])
+            if "code" in query:
+                matched_ids = set(network.ids_by_code.get(query["code"][0], []))
+            if "bbox" in query:
+                bbox = [float(v) for v in query["bbox"][0].split(",")]
+                in_bbox = network.search_bbox(bbox)
+                matched_ids = in_bbox if matched_ids is None else matched_ids & in_bbox
+            if "point" in query:
+                lon, lat = [float(v) for v in query["point"][0].split(",")]
+                matched_ids = network.search_point(lon, lat)
+            part = query.get("part", ["tributary"])[0]
+            tolerance = float(query.get("simplify", [0])[0])
+            if matched_ids is None or part not in ("main", "tributary"):
+                raise ValueError(url.query)
+        except ValueError:
+            self.send_error(400)
+            return
+        if not matched_ids:
+            self.send_error(404, "no matching troncon")
+            return
+        name, code_carth, main_items, tributary_items = \
+            network.select_river_items(matched_ids)
+        items = main_items if part == "main" else tributary_items
+        if tolerance:
+            items = simplify_items(items, tolerance)
+        filename = "{0} - {1} - {2}.osm.gz".format(code_carth, name.replace("/", "-"), part)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Disposition",
+                         "attachment; filename*=UTF-8''" + urllib.parse.quote(filename))
+        self.end_headers()
+        with gzip.GzipFile(fileobj=self.wfile, mode="wb") as gz, \
+                io.TextIOWrapper(gz, encoding="utf-8") as f:
+            write_items_as_osm(items, network.transformations()[0], f)
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+
+class ExtractionServerMixIn(object):
+    """Hand each request to a pool of worker threads sharing the network."""
+    def init_pool(self, network, workers):
+        import concurrent.futures
+        self.network = network
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve(shp_path, address, workers):
+    """Serve extractions on address, 'host:port' or 'unix:/path/to/socket'."""
+    import http.server
+    import socketserver
+    class ExtractionRequestHandler(ExtractionRequestHandlerMixIn,
+                                   http.server.BaseHTTPRequestHandler):
+        pass
+    class ExtractionServer(ExtractionServerMixIn, http.server.HTTPServer):
+        pass
+    class UnixExtractionServer(ExtractionServerMixIn, socketserver.UnixStreamServer):
+        pass
+    network = Network(shp_path)
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixExtractionServer(path, ExtractionRequestHandler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = ExtractionServer((host, int(port)), ExtractionRequestHandler)
+    server.init_pool(network, workers)
+    if VERBOSE:
+        sys.stderr.write("serve on {0}\n".format(address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+
+
 def main(argv):
     parser = argparse.ArgumentParser(description="Extrait le filaire d'une rivière au format OSM")
-    parser.add_argument('-s', '--shp', dest='shp', help="Shapefile des tronçons a utiliser")
-    parser.add_argument('search', metavar="RECHERCHE",
+    parser.add_argument('-s', '--shp', dest='shp',
+                        help="Shapefile (ou base .sqlite) des tronçons a utiliser")
+    parser.add_argument('--sqlite', dest='sqlite',
+                        help="Base SQLite indexée des tronçons, créée depuis le shapefile"
+                             " si elle n'existe pas, à utiliser à la place du shapefile")
+    parser.add_argument('-m', '--manifest', dest='manifest',
+                        help="Manifeste JSON des extractions déjà réalisées")
+    parser.add_argument('-u', '--update', dest='update', action='store_true',
+                        help="Ré-extrait uniquement les cours d'eau du manifeste"
+                             " modifiés dans la nouvelle édition du shapefile")
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help="Reprend une extraction interrompue: les cours d'eau du"
+                             " manifeste déjà extraits, dont les fichiers sont intacts,"
+                             " ne sont pas ré-extraits")
+    parser.add_argument('--departements', dest='departements', metavar="MOTIF",
+                        help="Couches TRONCON_HYDROGRAPHIQUE par département à utiliser"
+                             " (répertoire, ou motif glob des couches ou des répertoires)"
+                             " au lieu de la couche nationale")
+    parser.add_argument('--catalogue', dest='catalogue', default="departements.json",
+                        help="Catalogue des couches par département (défaut: departements.json)")
+    parser.add_argument('--ordre-min', dest='min_order', type=int,
+                        help="Ordre de Strahler minimal des affluents extraits (avec --sqlite)")
+    parser.add_argument('--simplifier', dest='simplify', type=float, metavar="METRES",
+                        help="Simplifie le tracé des tronçons avec cette tolérance en mètres")
+    parser.add_argument('--tuiles', dest='tile_size', type=float, metavar="DEGRES",
+                        help="Découpe la sortie en tuiles de DEGRES degrés, listées"
+                             " dans un fichier index .index.json")
+    parser.add_argument('--max-noeuds', dest='max_nodes', type=int, metavar="N",
+                        help="Découpe la sortie en fichiers d'au plus N nœuds,"
+                             " listés dans un fichier index .index.json")
+    parser.add_argument('--surfaces', dest='surfaces', action='store_true',
+                        help="Extrait aussi les surfaces en eau (lacs, retenues, larges cours"
+                             " d'eau) liées au cours d'eau")
+    parser.add_argument('--surfaces-shp', dest='surfaces_shp', metavar="SHP",
+                        help="Shapefile SURFACE_HYDROGRAPHIQUE à utiliser avec --surfaces"
+                             " (défaut: celui de la même livraison que les tronçons)")
+    parser.add_argument('--somme-controle', dest='checksum', metavar="ALGO:SOMME",
+                        help="Somme de contrôle (md5:... ou sha256:...) de l'archive BD Topo"
+                             " à télécharger, par défaut celle publiée à côté de l'archive")
+    parser.add_argument('--segments', dest='segments', type=int, default=4,
+                        help="Nombre de segments de l'archive BD Topo téléchargés en"
+                             " parallèle (défaut: 4)")
+    parser.add_argument('-c', '--cache', dest='cache',
+                        help="Répertoire du cache des extractions")
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=1024,
+                        help="Taille maximale du cache en Mo (défaut: 1024)")
+    parser.add_argument('--serve', dest='serve', metavar="ADRESSE",
+                        help="Garde le réseau en mémoire et sert les extractions en HTTP"
+                             " sur ADRESSE (hote:port ou unix:/chemin/socket)")
+    parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count(),
+                        help="Nombre de requêtes traitées en parallèle par le serveur")
+    parser.add_argument('search', metavar="RECHERCHE", nargs='*',
                         help="Nom du cours d'eau ou Code Carthage (ref:sandre)")
     args = parser.parse_args(argv)
+    if args.update and not args.manifest:
+        parser.error("--update nécessite --manifest")
+    if args.resume and not args.manifest:
+        parser.error("--resume nécessite --manifest")
+    if not args.update and not args.serve and not args.search:
+        parser.error("RECHERCHE manquante")
+    if args.surfaces and not args.surfaces_shp:
+        if args.departements:
+            parser.error("--surfaces nécessite --surfaces-shp avec --departements")
+        # next to the shapefile, before args.shp is replaced by the --sqlite base
+        args.surfaces_shp = get_surfaces_path(args.shp or PATH_SHP)
+    if args.departements:
+        if args.shp or args.sqlite:
+            parser.error("--departements est incompatible avec --shp et --sqlite")
+        if not args.catalogue.endswith(".json"):
+            parser.error("l'extension du catalogue doit être .json")
+        build_departements_catalogue(args.departements, args.catalogue)
+        args.shp = args.catalogue
+    if args.sqlite:
+        if not args.sqlite.endswith(".sqlite"):
+            parser.error("l'extension de la base doit être .sqlite")
+        if os.path.exists(args.sqlite) and args.shp:
+            with SqliteTroncons(args.sqlite) as troncons:
+                imported_identity = troncons.shp_identity()
+            if imported_identity != shp_identity(args.shp):
+                if VERBOSE:
+                    sys.stderr.write("{0} was not imported from {1}\n".format(
+                        args.sqlite, args.shp))
+                import_troncons_sqlite(args.shp, args.sqlite)
+        if not os.path.exists(args.sqlite):
+            import_troncons_sqlite(
+                args.shp or get_bd_hydro_troncons_shp(args.checksum, args.segments),
+                args.sqlite)
+        with SqliteTroncons(args.sqlite) as troncons:
+            has_catchments = troncons.has_catchments()
+        if not has_catchments:
+            build_catchments(args.sqlite)
+        args.shp = args.sqlite
+    elif args.min_order is not None:
+        parser.error("--ordre-min nécessite --sqlite")
     if args.shp is None:
-        args.shp = get_bd_hydro_troncons_shp()
-    extract_river(args.shp, args.search)
+        args.shp = get_bd_hydro_troncons_shp(args.checksum, args.segments)
+    if args.serve:
+        serve(args.shp, args.serve, args.workers)
+        return
+    cache = None
+    if args.cache:
+        cache = ResultCache(args.cache, args.cache_size * 1024 * 1024)
+    options = ExtractOptions(min_order=args.min_order, simplify=args.simplify,
+                             tile_size=args.tile_size, max_nodes=args.max_nodes,
+                             surfaces=args.surfaces_shp if args.surfaces else None)
+    if args.manifest:
+        extract_rivers_with_manifest(args.shp, args.search, args.manifest, args.update,
+                                     cache, options, args.resume)
+    else:
+        for search in args.search:
+            extract_river(args.shp, search, cache, options)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,398 @@
+#
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+
+Geometry helpers working on lists or arrays of coordinates
+
+"""
+
+import math
+import array
+
+EARTH_RADIUS = 6371000.0 # in metter
+
+
+def haversine_distance(lon1, lat1, lon2, lat2):
+    """ Great-circle distance in metters between two points given in degrees. """
+    # http://fr.wikipedia.org/wiki/Distance_du_grand_cercle
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def bearing(lon1, lat1, lon2, lat2):
+    """ Bearing in degrees from the first to the second point, in an
+        equirectangular approximation.
+    """
+    dy = lat2 - lat1
+    dx = math.cos(math.pi / 180 * lat1) * (lon2 - lon1)
+    return 180 * math.atan2(dx, dy) / math.pi
+
+
+def haversine_distances(lons1, lats1, lons2, lats2):
+    """ Same as haversine_distance() for sequences of points, returning an
+        array of the distances.
+    """
+    radians = math.pi / 180
+    sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+    result = array.array('d', bytes(8 * len(lons1)))
+    for i in range(len(lons1)):
+        lat1 = lats1[i] * radians
+        lat2 = lats2[i] * radians
+        a = (sin((lat2 - lat1) / 2) ** 2
+             + cos(lat1) * cos(lat2) * sin((lons2[i] * radians - lons1[i] * radians) / 2) ** 2)
+        result[i] = 2 * EARTH_RADIUS * asin(sqrt(a))
+    return result
+
+
+def bearings(lons1, lats1, lons2, lats2):
+    """ Same as bearing() for sequences of points, returning an array of
+        the bearings.
+    """
+    cos, atan2, pi = math.cos, math.atan2, math.pi
+    result = array.array('d', bytes(8 * len(lons1)))
+    for i in range(len(lons1)):
+        lat1 = lats1[i]
+        dx = cos(pi / 180 * lat1) * (lons2[i] - lons1[i])
+        result[i] = 180 * atan2(dx, lats2[i] - lat1) / pi
+    return result
+
+
+class NodeCoordinates(object):
+    """ Coordinates of nodes, parsed once and stored in two arrays of
+        doubles, so that the computations on many ways (way_bearings(),
+        way_lengths(), way_bboxes()) do not go through the node objects.
+    """
+    def __init__(self):
+        self.lons = array.array('d')
+        self.lats = array.array('d')
+        self.index = {} # node id -> index in the arrays
+        self.removed = 0
+    def __len__(self):
+        return len(self.index)
+    def __contains__(self, node_id):
+        return node_id in self.index
+    def add(self, node_id, lon, lat):
+        i = self.index.get(node_id)
+        if i is None:
+            self.index[node_id] = len(self.lons)
+            self.lons.append(lon)
+            self.lats.append(lat)
+        else:
+            self.lons[i] = lon
+            self.lats[i] = lat
+    def remove(self, node_id):
+        del self.index[node_id]
+        self.removed += 1
+    def compact(self):
+        """ Drop the coordinates of the removed nodes from the arrays. """
+        if self.removed:
+            lons, lats = self.lons, self.lats
+            self.lons = array.array('d', (lons[i] for i in self.index.values()))
+            self.lats = array.array('d', (lats[i] for i in self.index.values()))
+            self.index = dict(zip(self.index, range(len(self.index))))
+            self.removed = 0
+    def lonlat(self, node_id):
+        i = self.index[node_id]
+        return self.lons[i], self.lats[i]
+    def bbox(self):
+        """ Return the BBox of the nodes. """
+        self.compact()
+        bbox = BBox()
+        bbox.extend_all(self.lons, self.lats)
+        return bbox
+
+
+def way_end_indexes(ways, index):
+    """ Indexes of the first, second, before last and last nodes of ways
+        (lists of node ids), in four lists.
+    """
+    firsts, seconds, before_lasts, lasts = [], [], [], []
+    for node_ids in ways:
+        firsts.append(index[node_ids[0]])
+        seconds.append(index[node_ids[min(1, len(node_ids) - 1)]])
+        before_lasts.append(index[node_ids[max(-2, -len(node_ids))]])
+        lasts.append(index[node_ids[-1]])
+    return firsts, seconds, before_lasts, lasts
+
+
+def way_bearings(ways, coordinates):
+    """ Start and end bearings of ways (lists of node ids), from their two
+        first and two last nodes only, in two arrays.
+    """
+    lons, lats = coordinates.lons, coordinates.lats
+    firsts, seconds, before_lasts, lasts = way_end_indexes(ways, coordinates.index)
+    points = [([lons[i] for i in indexes], [lats[i] for i in indexes])
+              for indexes in (firsts, seconds, before_lasts, lasts)]
+    return (bearings(*(points[0] + points[1])),
+            bearings(*(points[2] + points[3])))
+
+
+def way_lengths(ways, coordinates):
+    """ Lengths in metters of ways (lists of node ids), in an array. """
+    index, lons, lats = coordinates.index, coordinates.lons, coordinates.lats
+    starts, ends, offsets = [], [], [0]
+    for node_ids in ways:
+        indexes = [index[node_id] for node_id in node_ids]
+        starts.extend(indexes[:-1])
+        ends.extend(indexes[1:])
+        offsets.append(len(starts))
+    distances = haversine_distances(
+        [lons[i] for i in starts], [lats[i] for i in starts],
+        [lons[i] for i in ends], [lats[i] for i in ends])
+    return array.array('d', (math.fsum(distances[offsets[i]:offsets[i + 1]])
+                             for i in range(len(offsets) - 1)))
+
+
+def way_bboxes(ways, coordinates):
+    """ Bounding boxes (minlon, minlat, maxlon, maxlat) of ways (lists of
+        node ids), in a list.
+    """
+    index, lons, lats = coordinates.index, coordinates.lons, coordinates.lats
+    result = []
+    for node_ids in ways:
+        indexes = [index[node_id] for node_id in node_ids]
+        way_lons = [lons[i] for i in indexes]
+        way_lats = [lats[i] for i in indexes]
+        result.append((min(way_lons), min(way_lats), max(way_lons), max(way_lats)))
+    return result
+
+
+def simplify(xs, ys, tolerance, keep=()):
+    """ Douglas-Peucker simplification of the polyline (xs, ys), in metters.
+
+        Return the sorted list of the indexes of the kept points. The first
+        and last points, and the points listed in keep, are always kept: the
+        polyline is simplified separately between them.
+    """
+    size = len(xs)
+    if size <= 2:
+        return list(range(size))
+    tolerance2 = tolerance * tolerance
+    kept = [False] * size
+    kept[0] = kept[-1] = True
+    for i in keep:
+        kept[i] = True
+    anchors = [i for i in range(size) if kept[i]]
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x1, y1 = xs[first], ys[first]
+        dx, dy = xs[last] - x1, ys[last] - y1
+        length2 = dx * dx + dy * dy
+        max_distance2 = -1.0
+        max_index = None
+        for i in range(first + 1, last):
+            px, py = xs[i] - x1, ys[i] - y1
+            if length2 == 0:
+                distance2 = px * px + py * py
+            else:
+                # distance to the segment [first, last]
+                t = max(0.0, min(1.0, (px * dx + py * dy) / length2))
+                ex, ey = px - t * dx, py - t * dy
+                distance2 = ex * ex + ey * ey
+            if distance2 > max_distance2:
+                max_distance2 = distance2
+                max_index = i
+        if max_distance2 > tolerance2:
+            kept[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [i for i in range(size) if kept[i]]
+
+
+def lonlat_to_local_metters(lons, lats):
+    """ Equirectangular projection of WGS84 coordinates to metters, precise
+        enough at the scale of a way.
+    """
+    if not lats:
+        return [], []
+    lat0 = math.radians(sum(lats) / len(lats))
+    kx = math.cos(lat0) * math.pi * EARTH_RADIUS / 180
+    ky = math.pi * EARTH_RADIUS / 180
+    return [lon * kx for lon in lons], [lat * ky for lat in lats]
+
+
+class BBox(object):
+    """ Bounding box extended point by point (or by other boxes). """
+    def __init__(self):
+        self.minlon = self.minlat = math.inf
+        self.maxlon = self.maxlat = -math.inf
+    def extend(self, lon, lat):
+        if lon < self.minlon: self.minlon = lon
+        if lon > self.maxlon: self.maxlon = lon
+        if lat < self.minlat: self.minlat = lat
+        if lat > self.maxlat: self.maxlat = lat
+    def extend_all(self, lons, lats):
+        if len(lons):
+            self.extend(min(lons), min(lats))
+            self.extend(max(lons), max(lats))
+    def extend_bbox(self, bbox):
+        """ bbox: (minlon, minlat, maxlon, maxlat) or None. """
+        if bbox is not None:
+            self.extend(bbox[0], bbox[1])
+            self.extend(bbox[2], bbox[3])
+    def bbox(self):
+        """ Return (minlon, minlat, maxlon, maxlat) or None if empty. """
+        if self.minlon > self.maxlon:
+            return None
+        return self.minlon, self.minlat, self.maxlon, self.maxlat
+
+
+def chunk_indexes(starts, sizes, tile_size=None, max_nodes=None):
+    """ Split ways in chunks, for their output in several files.
+
+        starts: (lon, lat) of the first node of each way
+        sizes: number of nodes of each way
+        The ways are grouped by tiles of tile_size degrees, and the ways of a
+        tile are split in chunks of at most max_nodes nodes (a chunk holds
+        at least one way). Return the list of the lists of way indexes of
+        each chunk.
+    """
+    tiles = {}
+    for i, (lon, lat) in enumerate(starts):
+        if tile_size:
+            key = (math.floor(lon / tile_size), math.floor(lat / tile_size))
+        else:
+            key = None
+        tiles.setdefault(key, []).append(i)
+    chunks = []
+    for key in sorted(tiles, key=lambda k: k or ()):
+        chunk = []
+        chunk_size = 0
+        for i in tiles[key]:
+            if max_nodes and chunk and chunk_size + sizes[i] > max_nodes:
+                chunks.append(chunk)
+                chunk = []
+                chunk_size = 0
+            chunk.append(i)
+            chunk_size += sizes[i]
+        if chunk:
+            chunks.append(chunk)
+    return chunks
+
+
+def polygon_contains(rings, x, y):
+    """ Tell if the point (x, y) is inside the polygon given by its rings
+        (outer ring first, then its holes), with the even-odd rule.
+    """
+    inside = False
+    for ring in rings:
+        x1, y1 = ring[-1][0], ring[-1][1]
+        for point in ring:
+            x2, y2 = point[0], point[1]
+            if (y2 > y) != (y1 > y) and x < (x1 - x2) * (y - y2) / (y1 - y2) + x2:
+                inside = not inside
+            x1, y1 = x2, y2
+    return inside
+
+
+def segments_intersect(x1, y1, x2, y2, x3, y3, x4, y4):
+    """ Tell if the segments [(x1, y1), (x2, y2)] and [(x3, y3), (x4, y4)]
+        have a common point.
+    """
+    def orientation(ax, ay, bx, by, cx, cy):
+        cross = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+        return (cross > 0) - (cross < 0)
+    def on_segment(ax, ay, bx, by, cx, cy):
+        # c is on the line ab, is it between a and b?
+        return min(ax, bx) <= cx <= max(ax, bx) and min(ay, by) <= cy <= max(ay, by)
+    o1 = orientation(x1, y1, x2, y2, x3, y3)
+    o2 = orientation(x1, y1, x2, y2, x4, y4)
+    o3 = orientation(x3, y3, x4, y4, x1, y1)
+    o4 = orientation(x3, y3, x4, y4, x2, y2)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and on_segment(x1, y1, x2, y2, x3, y3))
+            or (o2 == 0 and on_segment(x1, y1, x2, y2, x4, y4))
+            or (o3 == 0 and on_segment(x3, y3, x4, y4, x1, y1))
+            or (o4 == 0 and on_segment(x3, y3, x4, y4, x2, y2)))
+
+
+def segment_intersects_polygon(rings, x1, y1, x2, y2):
+    """ Tell if the segment [(x1, y1), (x2, y2)] has a point inside the
+        polygon given by its rings or on their boundary: an end of the
+        segment is inside, or the segment crosses a ring.
+    """
+    if polygon_contains(rings, x1, y1) or polygon_contains(rings, x2, y2):
+        return True
+    minx, maxx = min(x1, x2), max(x1, x2)
+    miny, maxy = min(y1, y2), max(y1, y2)
+    for ring in rings:
+        x3, y3 = ring[-1][0], ring[-1][1]
+        for point in ring:
+            x4, y4 = point[0], point[1]
+            if (not (max(x3, x4) < minx or min(x3, x4) > maxx
+                     or max(y3, y4) < miny or min(y3, y4) > maxy)
+                    and segments_intersect(x1, y1, x2, y2, x3, y3, x4, y4)):
+                return True
+            x3, y3 = x4, y4
+    return False
+
+
+def bbox_intersects(bbox1, bbox2):
+    return (bbox1[0] <= bbox2[2] and bbox2[0] <= bbox1[2]
+            and bbox1[1] <= bbox2[3] and bbox2[1] <= bbox1[3])
+
+
+class STRtree(object):
+    """ Static R-tree of bounding boxes packed with the Sort-Tile-Recursive
+        algorithm, to find the boxes intersecting a box without testing
+        all of them.
+    """
+    def __init__(self, bboxes, node_capacity=16):
+        """ bboxes: list of (minx, miny, maxx, maxy), the queries return
+            indexes in this list.
+        """
+        self.node_capacity = node_capacity
+        # an entry is (bbox, index) at the leaves, (bbox, entries) above
+        entries = [(bbox, i) for i, bbox in enumerate(bboxes)]
+        self.height = 0
+        while len(entries) > node_capacity:
+            entries = self.pack(entries)
+            self.height += 1
+        self.root = entries
+    def pack(self, entries):
+        capacity = self.node_capacity
+        node_count = math.ceil(len(entries) / capacity)
+        slice_size = math.ceil(math.sqrt(node_count)) * capacity
+        entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+        nodes = []
+        for i in range(0, len(entries), slice_size):
+            vertical_slice = sorted(entries[i:i + slice_size],
+                                    key=lambda e: e[0][1] + e[0][3])
+            for j in range(0, len(vertical_slice), capacity):
+                children = vertical_slice[j:j + capacity]
+                bbox = (min(e[0][0] for e in children), min(e[0][1] for e in children),
+                        max(e[0][2] for e in children), max(e[0][3] for e in children))
+                nodes.append((bbox, children))
+        return nodes
+    def query(self, bbox):
+        """ Return the indexes of the boxes intersecting bbox. """
+        result = []
+        stack = [(self.root, self.height)]
+        while stack:
+            entries, height = stack.pop()
+            for entry_bbox, child in entries:
+                if bbox_intersects(entry_bbox, bbox):
+                    if height:
+                        stack.append((child, height - 1))
+                    else:
+                        result.append(child)
+        return result
@@ -14,33 +14,24 @@
 
 
 import re
+import os
 import sys
+import glob
 import gzip
-import math
+import json
+import sqlite3
+import argparse
 import collections
-
-import osgeo
-import fiona.crs
+import concurrent.futures
 
 import osm
+import geometry
 
 SOURCE = "BDOrtho IGN Hydrographie 3.0 2020-09"
 VERBOSE = True
 
 same_value = lambda v:v
 
-
-uniq_dict={}
-def uniq_value(v):
-    result = uniq_dict.get(v)
-    if result is None:
-        uniq_dict[v] = v
-        result = v
-    return result
-
-def uniq(func):
-    return lambda v:uniq_value(func(v))
-
 def capitalize_word(word):
     if word in ("du", "de", "le", "la", "des", "les"):
         word = word.lower()
@@ -78,7 +69,7 @@ WAY_TAG_ACTIONS = [
     ("NOM", [
         (u"NC" , []),
         (u"NR" , []),
-        (u".*" , [TagSet("name", uniq(same_value))]),
+        (u".*" , [TagSet("name", same_value)]),
     ]),
     ("ARTIF", [
         (u"oui" , [TagSet("waterway", "drain"), TagAppend("note", u"man made waterway")]),
@@ -100,10 +91,10 @@ WAY_TAG_ACTIONS = [
     ]),
     ("PREC_ALTI", [
         (".*" , [
-            IfAction(has_tag("Z_INI"), WayNodeIndexAction(0, TagSet("ele:accuracy", uniq(same_value)))),
-            IfAction(has_tag("Z_FIN"), WayNodeIndexAction(-1, TagSet("ele:accuracy", uniq(same_value)))),
+            IfAction(has_tag("Z_INI"), WayNodeIndexAction(0, TagSet("ele:accuracy", same_value))),
+            IfAction(has_tag("Z_FIN"), WayNodeIndexAction(-1, TagSet("ele:accuracy", same_value))),
             WayNodesAction(
-                IfAction(has_tag("ele"), TagSet("ele:accuracy", uniq(same_value)))),
+                IfAction(has_tag("ele"), TagSet("ele:accuracy", same_value))),
         ]),
     ]),
     ("Z_INI", [
@@ -125,7 +116,7 @@ WAY_TAG_ACTIONS = [
 
     # Version 3 de la BD Ortho Hydrograhpie
     ("NOM_C_EAU", [
-        (".*" , [TagSet("name", uniq(capitalize_name))]),
+        (".*" , [TagSet("name", capitalize_name)]),
     ]),
     ("LARGEUR", [
         (u"Sans objet", [TagSet("waterway", "stream")]),
@@ -152,7 +143,7 @@ WAY_TAG_ACTIONS = [
         ("non" , []),
     ]),
     ("PREC_PLANI", [
-        (".*" , [TagSet("location:accuracy", uniq(same_value))]),
+        (".*" , [TagSet("location:accuracy", same_value)]),
     ]),
     ("POS_SOL", [
         ("-1" , [TagSet("tunnel", "yes"), TagSet("layer", "-1")]),
@@ -171,48 +162,48 @@ WAY_TAG_ACTIONS = [
         (".*" , [TagSet("source:date", lambda v:v.split()[0])]),
     ]),
     ("CODE_CARTH", [
-        (".*" , [TagSet("ref:sandre", uniq(same_value))]),
+        (".*" , [TagSet("ref:sandre", same_value)]),
     ]),
     ("ETAT", [
         (u"En projet" , [TagAppend("fixme", u"En projet, travaux non démarrés")]),
-        (u"En construction" , [TagAppend("fixme", uniq(same_value))]),
+        (u"En construction" , [TagAppend("fixme", same_value)]),
         (u"En service" , []),
         (u"Non exploité" , []),
     ]),
     ("NATURE", [
         (u"Ecoulement naturel" , []),
-        (u"Aqueduc" , [TagAppend("note", uniq(same_value)),
+        (u"Aqueduc" , [TagAppend("note", same_value),
                      TagSet("bridge", "aqueduct"),
                      TagSet("layer", "1"),]),
-        (u"Canal" , [TagAppend("note", uniq(same_value)),
+        (u"Canal" , [TagAppend("note", same_value),
                    TagSet("waterway", "canal"), ]),
-        (u"Conduit buse" , [TagAppend("note", uniq(same_value)),
+        (u"Conduit buse" , [TagAppend("note", same_value),
                      TagSet("tunnel", "flooded"),
                      TagSet("layer", "-1"),]),
-        (u"Conduit forcé" , [TagAppend("note", uniq(same_value)),
+        (u"Conduit forcé" , [TagAppend("note", same_value),
                            TagSet("waterway", "pressurised"),]),
-        (u"Delta" , [TagAppend("note", uniq(same_value))]),
-        (u"Ecoulement canalisé" , [TagAppend("note", uniq(same_value))]),
-        (u"Ecoulement endoréique" , [TagAppend("note", uniq(same_value))]),
-        (u"Ecoulement karstique" , [TagAppend("note", uniq(same_value))]),
-        (u"Ecoulement phréatique" , [TagAppend("note", uniq(same_value))]),
-        (u"Estuaire" , [TagAppend("note", uniq(same_value))]),
-        (u"Glacier, névé" , [TagAppend("note", uniq(same_value))]),
+        (u"Delta" , [TagAppend("note", same_value)]),
+        (u"Ecoulement canalisé" , [TagAppend("note", same_value)]),
+        (u"Ecoulement endoréique" , [TagAppend("note", same_value)]),
+        (u"Ecoulement karstique" , [TagAppend("note", same_value)]),
+        (u"Ecoulement phréatique" , [TagAppend("note", same_value)]),
+        (u"Estuaire" , [TagAppend("note", same_value)]),
+        (u"Glacier, névé" , [TagAppend("note", same_value)]),
         (u"Inconnue" , []),
-        (u"Lac" , [TagAppend("note", uniq(same_value))]),
-        (u"Lagune" , [TagAppend("note", uniq(same_value))]),
-        (u"Mangrove" , [TagAppend("note", uniq(same_value))]),
-        (u"Marais" , [TagAppend("note", uniq(same_value))]),
-        (u"Mare" , [TagAppend("note", uniq(same_value))]),
-        (u"Plan d'eau de gravière" , [TagAppend("note", uniq(same_value))]),
-        (u"Plan d'eau de mine" , [TagAppend("note", uniq(same_value))]),
-        (u"Réservoir-bassin" , [TagAppend("note", uniq(same_value))]),
-        (u"Réservoir-bassin d'orage" , [TagAppend("note", uniq(same_value))]),
-        (u"Réservoir-bassin piscicole" , [TagAppend("note", uniq(same_value))]),
-        (u"Retenue" , [TagAppend("note", uniq(same_value))]),
-        (u"Retenue-barrage" , [TagAppend("note", uniq(same_value))]),
-        (u"Retenue-bassin portuaire" , [TagAppend("note", uniq(same_value))]),
-        (u"Retenue-digue" , [TagAppend("note", uniq(same_value))]),
+        (u"Lac" , [TagAppend("note", same_value)]),
+        (u"Lagune" , [TagAppend("note", same_value)]),
+        (u"Mangrove" , [TagAppend("note", same_value)]),
+        (u"Marais" , [TagAppend("note", same_value)]),
+        (u"Mare" , [TagAppend("note", same_value)]),
+        (u"Plan d'eau de gravière" , [TagAppend("note", same_value)]),
+        (u"Plan d'eau de mine" , [TagAppend("note", same_value)]),
+        (u"Réservoir-bassin" , [TagAppend("note", same_value)]),
+        (u"Réservoir-bassin d'orage" , [TagAppend("note", same_value)]),
+        (u"Réservoir-bassin piscicole" , [TagAppend("note", same_value)]),
+        (u"Retenue" , [TagAppend("note", same_value)]),
+        (u"Retenue-barrage" , [TagAppend("note", same_value)]),
+        (u"Retenue-bassin portuaire" , [TagAppend("note", same_value)]),
+        (u"Retenue-digue" , [TagAppend("note", same_value)]),
     ]),
     ("NAVIGABL", [
         (u"oui" , [TagSet("motorboat", "yes")]),
@@ -273,6 +264,9 @@ WAY_ACTIONS = [
 ]
 
 def read_shp_as_osm(shp_path, add_ele_tag=True):
+    # imported only here, for a fast startup on .osm files
+    import fiona.crs
+    import osgeo.osr
     osm_data = osm.Osm({})
     node_by_coord = {}
     dst_crs = osgeo.osr.SpatialReference()
@@ -308,34 +302,23 @@ def read_shp_as_osm(shp_path, add_ele_tag=True):
                 if add_ele_tag:
                     for node_index in (0, -1):
                         if coordinates[node_index][2] >= 0 and coordinates[node_index][2] < 5000:
-                            osm_data.nodes[way.nodes[node_index]].tags["ele"] = str(z)
+                            osm_data.nodes[way.nodes[node_index]].mutable_tags()["ele"] = str(z)
     if VERBOSE:
         sys.stderr.write("\n")
     return osm_data
 
 
-def bearing(node1, node2):
-    dy = node2.lat() - node1.lat();
-    dx = math.cos(math.pi/180*node1.lat())*(node2.lon() - node1.lon());
-    return 180 * math.atan2(dx, dy) / math.pi;
-
 def angle_diff(angle1, angle2):
     return (angle1 - angle2 + 180) % 360 - 180
 
-def start_bearing(way, osm_data):
-    return bearing(
-        osm_data.nodes[way.nodes[0]],
-        osm_data.nodes[way.nodes[1]])
-
-def end_bearing(way, osm_data):
-    return bearing(
-        osm_data.nodes[way.nodes[-2]],
-        osm_data.nodes[way.nodes[-1]])
-
-def ways_angle(way1, way2, osm_data):
-    return abs(angle_diff(
-        end_bearing(way1, osm_data),
-        start_bearing(way2, osm_data)))
+def way_end_bearings(node_ids, nodes):
+    """Return the start and end bearings of a single way, from its two first
+    and two last nodes only (see geometry.way_bearings for many ways)."""
+    first, second, before_last, last = [nodes[node_id].coordinates() for node_id in
+        (node_ids[0], node_ids[min(1, len(node_ids) - 1)],
+         node_ids[max(-2, -len(node_ids))], node_ids[-1])]
+    return (geometry.bearing(*(first + second)),
+            geometry.bearing(*(before_last + last)))
 
 
 
@@ -343,13 +326,14 @@ def ways_angle(way1, way2, osm_data):
 def execute_action(action, obj, param, osm_data):
     if type(action) == TagSet:
         value = action.value(param) if callable(action.value) else action.value
-        obj.tags[action.key] = value
+        obj.mutable_tags()[action.key] = value
     elif type(action) == TagAppend:
         value = action.value(param) if callable(action.value) else action.value
-        if action.key in obj.tags:
-            obj.tags[action.key] = obj.tags[action.key]  + ";" + value
+        tags = obj.mutable_tags()
+        if action.key in tags:
+            tags[action.key] = tags[action.key]  + ";" + value
         else:
-            obj.tags[action.key] = value
+            tags[action.key] = value
     elif type(action) == WayNodeReverse:
         obj.nodes.reverse()
     elif type(action) == IfAction:
@@ -382,75 +366,135 @@ def modify_item(item, osm_data, item_tag_actions, item_actions):
             if found:
                 for action in actions:
                     execute_action(action, item, value, osm_data)
-                del item.tags[key]
+                del item.mutable_tags()[key]
             else:
                 raise Exception("unknown value " + key + "=" + value)
     for action in item_actions:
         execute_action(action, item, None, osm_data)
 
-def merge_ways(osm_data):
+def get_way_merges(ways, start_bearings, end_bearings):
+    """Choose the ways to merge, from their endpoints only.
+
+    ways: ordered dict way id -> [first node id, last node id, tags]
+    start_bearings, end_bearings: dicts way id -> bearing in degrees
+    Return the ordered list of (way id, id of the way to append it to).
+    ways and end_bearings are updated as the merges are chosen."""
 ## FIXME: loops are not handled correctly
 ## e.g.:   _____
 ##     ___/     \____
 ##        \_____/
-    node_begins_ways = collections.defaultdict(set)
     node_ends_ways = collections.defaultdict(set)
-    for way_id in osm_data.ways:
-        way = osm_data.ways[way_id]
-        node_begins_ways[way.nodes[0]].add(way_id)
-        node_ends_ways[way.nodes[-1]].add(way_id)
-    way_merge_ids = {way_id: way_id for way_id in osm_data.ways.keys()}
+    for way_id, (first, last, tags) in ways.items():
+        node_ends_ways[last].add(way_id)
+    way_merge_ids = {way_id: way_id for way_id in ways.keys()}
     def get_merged_id(way_id):
         while way_merge_ids[way_id] != way_id:
             way_id = way_merge_ids[way_id]
         return way_id
-    def get_previous_way_of_same_name(way):
-        name = way.tags.get("name")
+    def get_previous_way_of_same_name(way_id):
+        first, last, tags = ways[way_id]
+        name = tags.get("name")
         if name:
-            for prev_id in node_ends_ways[way.nodes[0]]:
-                prev_way = osm_data.ways[get_merged_id(prev_id)]
-                if prev_way.tags.get("name","") == name:
-                    return prev_way
+            for prev_id in node_ends_ways[first]:
+                prev_id = get_merged_id(prev_id)
+                if ways[prev_id][2].get("name","") == name:
+                    return prev_id
         return None
-    def get_way_to_merge(way):
-        prev_way = get_previous_way_of_same_name(way)
-        if prev_way is None:
-            if len(node_ends_ways[way.nodes[0]]) == 1:
-                prev_id = next(iter(node_ends_ways[way.nodes[0]]))
-                prev_way = osm_data.ways[get_merged_id(prev_id)]
-            elif len(node_ends_ways[way.nodes[0]]) >= 1:
-                prev_ways = [osm_data.ways[get_merged_id(i)]
-                             for i in node_ends_ways[way.nodes[0]]]
-                prev_ways.sort(key = lambda w: ways_angle(w, way, osm_data))
-                prev_way = prev_ways[0]
-        if prev_way and (prev_way.tags == way.tags) \
-                and (prev_way.nodes[-1] == way.nodes[0]):
-            return prev_way
+    def get_way_to_merge(way_id):
+        first, last, tags = ways[way_id]
+        prev_id = get_previous_way_of_same_name(way_id)
+        if prev_id is None:
+            if len(node_ends_ways[first]) == 1:
+                prev_id = get_merged_id(next(iter(node_ends_ways[first])))
+            elif len(node_ends_ways[first]) >= 1:
+                prev_ids = [get_merged_id(i) for i in node_ends_ways[first]]
+                prev_ids.sort(key = lambda i: abs(angle_diff(
+                    end_bearings[i], start_bearings[way_id])))
+                prev_id = prev_ids[0]
+        if prev_id is not None and (ways[prev_id][2] is tags) \
+                and (ways[prev_id][1] == first):
+            return prev_id
         else:
             return None
-    for way_id in list(osm_data.ways.keys()):
-        way = osm_data.ways[get_merged_id(way_id)]
-        way_to_merge = get_way_to_merge(way)
-        if way_to_merge:
-            way_to_merge.nodes = way_to_merge.nodes + way.nodes[1:]
-            del(osm_data.ways[way_id])
-            way_merge_ids[way_id] = way_to_merge.id()
-
-def main():
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]
-        sys.stderr.write("read\n")
-        if filename.endswith(".osm"):
-            osm_data = osm.OsmParser().parse(sys.argv[1])
-        elif filename.endswith(".osm.gz"):
-            with gzip.open(sys.argv[1]) as f:
+    merges = []
+    for way_id in list(ways.keys()):
+        target_id = get_way_to_merge(way_id)
+        if target_id is not None:
+            ways[target_id][1] = ways[way_id][1]
+            end_bearings[target_id] = end_bearings[way_id]
+            way_merge_ids[way_id] = target_id
+            merges.append((way_id, target_id))
+    return merges
+
+def merge_ways(osm_data):
+    # ways with the same tags share the same Tags object
+    osm_data.freeze_tags()
+    starts, ends = geometry.way_bearings(
+        [way.nodes for way in osm_data.ways.values()], osm_data.coordinates)
+    start_bearings = dict(zip(osm_data.ways, starts))
+    end_bearings = dict(zip(osm_data.ways, ends))
+    ways = collections.OrderedDict(
+        (way_id, [way.nodes[0], way.nodes[-1], way.tags])
+        for way_id, way in osm_data.ways.items())
+    for way_id, target_id in get_way_merges(ways, start_bearings, end_bearings):
+        way = osm_data.ways[way_id]
+        target = osm_data.ways[target_id]
+        target.nodes = target.nodes + way.nodes[1:]
+        del(osm_data.ways[way_id])
+
+def simplify_ways(osm_data, tolerance):
+    """Simplify the ways with a tolerance in metters, keeping their
+    endpoints, the nodes shared with other ways and the tagged nodes, then
+    remove the nodes no longer used."""
+    use_count = collections.Counter(
+        node_id for way in osm_data.ways.values() for node_id in way.nodes)
+    vertices_before = 0
+    vertices_after = 0
+    for way in osm_data.ways.values():
+        nodes = [osm_data.nodes[node_id] for node_id in way.nodes]
+        lonlats = [osm_data.coordinates.lonlat(node_id) for node_id in way.nodes]
+        xs, ys = geometry.lonlat_to_local_metters(
+            [lon for lon, lat in lonlats], [lat for lon, lat in lonlats])
+        kept = geometry.simplify(xs, ys, tolerance,
+            keep=[j for j, node in enumerate(nodes)
+                  if use_count[node.id()] > 1 or len(node.tags)])
+        vertices_before += len(way.nodes)
+        vertices_after += len(kept)
+        way.nodes = [way.nodes[j] for j in kept]
+    used_node_ids = set(
+        node_id for way in osm_data.ways.values() for node_id in way.nodes)
+    for relation in osm_data.relations.values():
+        for mtype, mref, mrole in relation.itermembers():
+            if mtype == "node":
+                used_node_ids.add(mref)
+    for node_id in list(osm_data.nodes.keys()):
+        if node_id not in used_node_ids and not len(osm_data.nodes[node_id].tags):
+            osm_data.remove_node(node_id)
+    if VERBOSE and vertices_before:
+        sys.stderr.write("simplify: {0} -> {1} vertices (-{2:.0f} %)\n".format(
+            vertices_before, vertices_after,
+            100.0 * (vertices_before - vertices_after) / vertices_before))
+
+def process_file(input_filename, output_filename, options):
+    """Convert the tags of input_filename (stdin if None) and write the
+    result in output_filename (stdout if None)."""
+    if options.low_memory:
+        process_file_low_memory(input_filename, output_filename)
+        return
+    if input_filename:
+        if VERBOSE:
+            sys.stderr.write("read\n")
+        if input_filename.endswith(".osm"):
+            osm_data = osm.OsmParser().parse(input_filename)
+        elif input_filename.endswith(".osm.gz"):
+            with gzip.open(input_filename) as f:
                 osm_data = osm.OsmParser().parse_stream(f)
-        elif filename.endswith(".shp"):
-            osm_data = read_shp_as_osm(sys.argv[1])
+        elif input_filename.endswith(".shp"):
+            osm_data = read_shp_as_osm(input_filename)
         else:
-            raise Exception("unsupported input file extension: "  + filename)
+            raise Exception("unsupported input file extension: "  + input_filename)
     else:
-        osm_data = osm.OsmParser().parse_stream(sys.stdin)
+        osm_data = osm.OsmParser().parse_stream(sys.stdin.buffer)
     if VERBOSE:
         sys.stderr.write("modify tags\n")
     for way_id in osm_data.ways:
@@ -458,16 +502,258 @@ def main():
     if VERBOSE:
         sys.stderr.write("merge ways\n")
     merge_ways(osm_data)
-    sys.stderr.write("write\n")
+    if options.simplify:
+        simplify_ways(osm_data, options.simplify)
+    if VERBOSE:
+        sys.stderr.write("write\n")
+    if options.tile_size or options.max_nodes:
+        osm.write_chunks(osm_data, output_filename, options.tile_size, options.max_nodes)
+    else:
+        write_osm(osm_data, output_filename)
+
+def write_osm(osm_data, output_filename):
     writer=osm.OsmWriter(osm_data)
-    if len(sys.argv) == 3:
-        if sys.argv[2].endswith(".gz"):
-            with gzip.open(sys.argv[2],"wt", encoding="utf-8") as f:
-                writer.write_to_stream(f)
-        else:
-            writer.write_to_file(sys.argv[2])
+    if output_filename:
+        with osm.atomic_open(output_filename) as f:
+            writer.write_to_stream(f)
     else:
         writer.write_to_stream(sys.stdout)
 
+class StoredNodes(object):
+    """Nodes stored in the database of a StoredOsm. Used as osm_data.nodes
+    by the actions: the nodes read are kept until flush() saves their
+    modified tags."""
+    def __init__(self, db):
+        self.db = db
+        self.loaded = {}
+    def __getitem__(self, node_id):
+        if node_id not in self.loaded:
+            row = self.db.execute(
+                "SELECT attrs, tags FROM nodes WHERE id = ?", (node_id,)).fetchone()
+            if row is None:
+                raise KeyError(node_id)
+            self.loaded[node_id] = (osm.Node(json.loads(row[0]), json.loads(row[1])), row[1])
+        return self.loaded[node_id][0]
+    def flush(self):
+        for node_id, (node, tags) in self.loaded.items():
+            if json.dumps(node.tags) != tags:
+                self.db.execute("UPDATE nodes SET tags = ? WHERE id = ?",
+                                (json.dumps(node.tags), node_id))
+        self.loaded.clear()
+    def values(self):
+        for attrs, tags in self.db.execute("SELECT attrs, tags FROM nodes ORDER BY seq"):
+            yield osm.Node(json.loads(attrs), json.loads(tags))
+
+class StoredItems(object):
+    """Items read from the database of a StoredOsm, for osm.OsmWriter."""
+    def __init__(self, iterate):
+        self.iterate = iterate
+    def values(self):
+        return self.iterate()
+
+class StoredOsm(object):
+    """OSM data too large to be held in memory: the nodes, ways and
+    relations are stored in a temporary SQLite database, only the endpoints,
+    tags and bearings of the ways are kept in memory for merge_ways()."""
+    def __init__(self):
+        # an empty name is a temporary database on disk
+        self.db = sqlite3.connect("")
+        self.db.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE nodes (seq INTEGER PRIMARY KEY, id INTEGER, attrs TEXT, tags TEXT);
+            CREATE UNIQUE INDEX nodes_id ON nodes (id);
+            CREATE TABLE ways (seq INTEGER PRIMARY KEY, id INTEGER, attrs TEXT, nodes TEXT);
+            CREATE UNIQUE INDEX ways_id ON ways (id);
+            CREATE TABLE relations (seq INTEGER PRIMARY KEY, attrs TEXT, tags TEXT, members TEXT);
+        """)
+        self.parser = None
+        self.osm_data = None
+        self.nodes = StoredNodes(self.db)
+        self.ways = collections.OrderedDict() # id -> [first node id, last node id, tags]
+        self.start_bearings = {}
+        self.end_bearings = {}
+        self.parts = None
+    def close(self):
+        self.db.close()
+    def add_item(self, item):
+        """Store an item read by osm.OsmStreamParser, modifying the ways."""
+        if item.type() == "node":
+            self.db.execute("INSERT INTO nodes (id, attrs, tags) VALUES (?, ?, ?)",
+                            (item.id(), json.dumps(item.attrs), json.dumps(item.tags)))
+        elif item.type() == "way":
+            modify_item(item, self, WAY_TAG_ACTIONS, WAY_ACTIONS)
+            self.start_bearings[item.id()], self.end_bearings[item.id()] = \
+                way_end_bearings(item.nodes, self.nodes)
+            self.nodes.flush()
+            self.db.execute("INSERT INTO ways (id, attrs, nodes) VALUES (?, ?, ?)",
+                            (item.id(), json.dumps(item.attrs), json.dumps(item.nodes)))
+            # ways with the same tags share the same Tags object
+            self.ways[item.id()] = [item.nodes[0], item.nodes[-1],
+                                    self.parser.osm.intern_tags(item.tags)]
+        else:
+            self.db.execute("INSERT INTO relations (attrs, tags, members) VALUES (?, ?, ?)",
+                            (json.dumps(item.attrs), json.dumps(item.tags),
+                             json.dumps(item.members)))
+    def read(self, stream):
+        """First pass: store the items of the stream and modify the ways."""
+        self.parser = osm.OsmStreamParser(self.add_item)
+        self.osm_data = self.parser.parse_stream(stream)
+        self.db.commit()
+    def merge_ways(self):
+        """Merge the ways from their endpoints only (see get_way_merges)."""
+        self.parts = collections.OrderedDict((way_id, [way_id]) for way_id in self.ways)
+        for way_id, target_id in get_way_merges(
+                self.ways, self.start_bearings, self.end_bearings):
+            parts = self.parts.pop(way_id)
+            if target_id != way_id:
+                self.parts[target_id].extend(parts)
+    def iter_ways(self):
+        for way_id, attrs in self.db.execute("SELECT id, attrs FROM ways ORDER BY seq"):
+            if way_id in self.parts:
+                way = osm.Way(json.loads(attrs), self.ways[way_id][2])
+                for part_id in self.parts[way_id]:
+                    nodes = json.loads(self.db.execute(
+                        "SELECT nodes FROM ways WHERE id = ?", (part_id,)).fetchone()[0])
+                    way.nodes.extend(nodes[1:] if way.nodes else nodes)
+                yield way
+    def iter_relations(self):
+        for attrs, tags, members in self.db.execute(
+                "SELECT attrs, tags, members FROM relations ORDER BY seq"):
+            relation = osm.Relation(json.loads(attrs), json.loads(tags))
+            relation.members = json.loads(members)
+            yield relation
+    def write(self, output_filename):
+        """Second pass: stream the stored items to the output."""
+        self.osm_data.nodes = self.nodes
+        self.osm_data.ways = StoredItems(self.iter_ways)
+        self.osm_data.relations = StoredItems(self.iter_relations)
+        write_osm(self.osm_data, output_filename)
+
+def process_file_low_memory(input_filename, output_filename):
+    """process_file() in two passes over the data stored on disk (see
+    StoredOsm), the memory used depending on the number of ways only."""
+    stored = StoredOsm()
+    try:
+        if VERBOSE:
+            sys.stderr.write("read and modify tags\n")
+        if input_filename is None:
+            stored.read(sys.stdin.buffer)
+        elif input_filename.endswith(".osm"):
+            with open(input_filename, "rb") as f:
+                stored.read(f)
+        elif input_filename.endswith(".osm.gz"):
+            with gzip.open(input_filename) as f:
+                stored.read(f)
+        else:
+            raise Exception("unsupported input file extension: "  + input_filename)
+        if VERBOSE:
+            sys.stderr.write("merge ways\n")
+        stored.merge_ways()
+        if VERBOSE:
+            sys.stderr.write("write\n")
+        stored.write(output_filename)
+    finally:
+        stored.close()
+
+def batch_output_filename(pattern, input_filename):
+    """Output filename of input_filename in batch mode: {nom} in pattern is
+    replaced by the name of the input file without its extension."""
+    name = os.path.basename(input_filename)
+    for ext in (".osm.gz", ".osm", ".shp"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    # not str.format(), the other braces of the pattern are kept
+    return pattern.replace("{nom}", name)
+
+def process_batch_file(input_filename, output_filename, options):
+    global VERBOSE
+    VERBOSE = False
+    try:
+        process_file(input_filename, output_filename, options)
+        return None
+    except Exception as e:
+        return "{0}: {1}".format(type(e).__name__, e)
+
+def process_batch(pattern, output_pattern, options, workers=None):
+    """Process all the files matching pattern (a glob or a directory) in a
+    pool of processes, the largest files first. Return the number of
+    failures, which are reported without stopping the batch."""
+    if os.path.isdir(pattern):
+        input_filenames = [os.path.join(pattern, name) for name in os.listdir(pattern)
+                           if name.endswith((".osm", ".osm.gz", ".shp"))]
+    else:
+        input_filenames = glob.glob(pattern)
+    input_filenames.sort(key=os.path.getsize, reverse=True)
+    # e.g. a.osm and a.osm.gz, the second one would overwrite the first one
+    input_by_output = {}
+    for input_filename in input_filenames:
+        output_filename = batch_output_filename(output_pattern, input_filename)
+        if output_filename in input_by_output:
+            raise Exception("{0} and {1} have the same output {2}".format(
+                input_by_output[output_filename], input_filename, output_filename))
+        input_by_output[output_filename] = input_filename
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(process_batch_file, input_filename, output_filename, options):
+            input_filename
+            for output_filename, input_filename in input_by_output.items()}
+        for done, future in enumerate(concurrent.futures.as_completed(futures)):
+            input_filename = futures[future]
+            try:
+                error = future.result()
+            except Exception as e:
+                # the worker process died
+                error = "{0}: {1}".format(type(e).__name__, e)
+            if error:
+                failures += 1
+                sys.stderr.write("ERROR {0}: {1}\n".format(input_filename, error))
+            elif VERBOSE:
+                sys.stderr.write("{0} / {1} {2}\n".format(
+                    done + 1, len(input_filenames), input_filename))
+    if VERBOSE:
+        sys.stderr.write("{0} files, {1} failures\n".format(len(input_filenames), failures))
+    return failures
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Convertit les attributs BD Topo Hydrographie en tags OSM")
+    parser.add_argument('input', metavar="ENTREE", nargs='?',
+                        help="Fichier .osm, .osm.gz ou .shp (défaut: entrée standard),"
+                             " ou avec --lot répertoire ou motif glob des fichiers")
+    parser.add_argument('output', metavar="SORTIE", nargs='?',
+                        help="Fichier .osm ou .osm.gz (défaut: sortie standard),"
+                             " ou avec --lot modèle des fichiers de sortie où {nom}"
+                             " est le nom du fichier d'entrée sans extension")
+    parser.add_argument('--lot', dest='batch', action='store_true',
+                        help="Traite tous les fichiers de ENTREE dans plusieurs processus")
+    parser.add_argument('--processus', dest='workers', type=int,
+                        help="Nombre de processus du mode --lot (défaut: nombre de cœurs)")
+    parser.add_argument('--simplifier', dest='simplify', type=float, metavar="METRES",
+                        help="Simplifie le tracé des chemins avec cette tolérance en mètres")
+    parser.add_argument('--tuiles', dest='tile_size', type=float, metavar="DEGRES",
+                        help="Découpe la sortie en tuiles de DEGRES degrés, listées"
+                             " dans un fichier index .index.json")
+    parser.add_argument('--max-noeuds', dest='max_nodes', type=int, metavar="N",
+                        help="Découpe la sortie en fichiers d'au plus N nœuds,"
+                             " listés dans un fichier index .index.json")
+    parser.add_argument('--memoire-reduite', dest='low_memory', action='store_true',
+                        help="Traite les fichiers plus grands que la mémoire en deux passes,"
+                             " les nœuds et chemins étant stockés dans une base temporaire")
+    args = parser.parse_args(argv)
+    if args.low_memory and (args.simplify or args.tile_size or args.max_nodes):
+        parser.error("--memoire-reduite est incompatible avec --simplifier, --tuiles et --max-noeuds")
+    if (args.tile_size or args.max_nodes) and not args.output:
+        parser.error("--tuiles et --max-noeuds nécessitent un fichier de SORTIE")
+    if args.batch:
+        if not args.input or not args.output or "{nom}" not in args.output:
+            parser.error("--lot nécessite ENTREE et un modèle de SORTIE contenant {nom}")
+        if process_batch(args.input, args.output, args, args.workers):
+            sys.exit(1)
+    else:
+        process_file(args.input, args.output, args)
+
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1:])
@@ -20,11 +20,14 @@ OSM file Parser/Writer
 """
 
 import sys
-import math
+import gzip
+import json
 import os.path
-import xml.sax.saxutils
 import xml.parsers.expat
 import itertools
+import contextlib
+
+import geometry
 
 class Osm(object):
     min_id = 0
@@ -35,6 +38,11 @@ class Osm(object):
         self.ways = {}
         self.relations = {}
         self.bounds = []
+        self.tags_pool = {}
+        self.values_pool = {}
+        # coordinates and bbox of the nodes, updated by add_node()
+        self.coordinates = geometry.NodeCoordinates()
+        self.nodes_bbox = geometry.BBox()
         if not ('version' in self.attrs):
           self.attrs['version'] = '0.6'
         if not ('generator' in self.attrs):
@@ -43,6 +51,15 @@ class Osm(object):
         id = node.id()
         assert(not (id in self.nodes))
         self.nodes[id] = node
+        lon, lat = node.coordinates()
+        self.coordinates.add(id, lon, lat)
+        if self.nodes_bbox is not None:
+            self.nodes_bbox.extend(lon, lat)
+    def remove_node(self, id):
+        del self.nodes[id]
+        self.coordinates.remove(id)
+        # recomputed from the coordinates by bbox() when needed
+        self.nodes_bbox = None
     def create_node(self, attrs,tags=None):
         node = Node(attrs, tags)
         self.add_node(node)
@@ -73,14 +90,10 @@ class Osm(object):
             maxlon = max([float(b["maxlon"]) for b in self.bounds])
             maxlat = max([float(b["maxlat"]) for b in self.bounds])
             return minlon,minlat,maxlon,maxlat
-        elif len(self.nodes):
-            minlon = min([n.lon() for n in self.nodes.values()])
-            minlat = min([n.lat() for n in self.nodes.values()])
-            maxlon = max([n.lon() for n in self.nodes.values()])
-            maxlat = max([n.lat() for n in self.nodes.values()])
-            return minlon,minlat,maxlon,maxlat
         else:
-            return None
+            if self.nodes_bbox is None:
+                self.nodes_bbox = self.coordinates.bbox()
+            return self.nodes_bbox.bbox()
     def set_bbox(self,bbox):
         self.bounds = []
         if bbox != None:
@@ -93,6 +106,31 @@ class Osm(object):
     def update_bbox(self):
         self.bounds = []
         self.set_bbox(self.bbox())
+    def way_lengths(self):
+        """ Lengths in metters of the ways, by way id. """
+        return dict(zip(self.ways, geometry.way_lengths(
+            [w.nodes for w in self.ways.values()], self.coordinates)))
+    def way_bboxes(self):
+        """ Bounding boxes of the ways, by way id. """
+        return dict(zip(self.ways, geometry.way_bboxes(
+            [w.nodes for w in self.ways.values()], self.coordinates)))
+    def intern_tags(self, tags):
+        """ Return the shared immutable Tags equal to tags. """
+        if not len(tags):
+            return EMPTY_TAGS
+        if isinstance(tags, Tags) and self.tags_pool.get(tags) is tags:
+            return tags
+        values_pool = self.values_pool
+        def uniq(v):
+            return values_pool.setdefault(v, v)
+        candidate = Tags((uniq(k), uniq(v)) for k, v in tags.items())
+        return self.tags_pool.setdefault(candidate, candidate)
+    def freeze_tags(self):
+        """ Replace the tags of every item by shared immutable Tags, so
+            that items with the same tags share the same Tags object.
+        """
+        for item in self.iteritems():
+            item.tags = self.intern_tags(item.tags)
     def iteritems(self):
         return itertools.chain.from_iterable(
                 [self.nodes.values(),
@@ -126,18 +164,127 @@ class Osm(object):
             elif i.type() == "relation":
               add_relation(i)
         def add_node(n):
-            result.nodes[n.id()] = n
+            if n.id() not in result.nodes:
+                result.add_node(n)
         def add_way(w):
             result.ways[w.id()] = w
             for node_id in w.nodes: add_node(self.nodes[node_id])
         def add_relation(r):
             result.relations[r.id()] = r
             for item, role in self.iter_relation_members(r):
-                add_item(i)
+                add_item(item)
         for i in items:
             add_item(i)
         return result
+    def chunks(self, tile_size=None, max_nodes=None):
+        """ Split the file in several Osm() files: the ways are grouped by
+            tiles of tile_size degrees (the tile of their first node) and
+            in chunks of at most max_nodes nodes (see geometry.chunk_indexes).
+            Nodes shared by several chunks are in each of them with the same
+            id, the relations and the nodes not used by the ways are in the
+            first chunk.
+        """
+        ways = list(self.ways.values())
+        groups = geometry.chunk_indexes(
+            [self.coordinates.lonlat(w.nodes[0]) for w in ways],
+            [len(w.nodes) for w in ways],
+            tile_size, max_nodes) or [[]]
+        used_node_ids = set(n for w in ways for n in w.nodes)
+        for number, group in enumerate(groups):
+            items = [ways[i] for i in group]
+            if number == 0:
+                items.extend(self.relations.values())
+                items.extend(n for n in self.nodes.values()
+                             if n.id() not in used_node_ids)
+            chunk = self.filter(items)
+            chunk.attrs.update(self.attrs)
+            chunk.update_bbox()
+            yield chunk
+
+
+@contextlib.contextmanager
+def atomic_open(filename):
+    """ Open filename to write text in it, gzip compressed if its name ends
+        with .gz. The text is written in a temporary file renamed to filename
+        once complete, so that an interrupted run never leaves a truncated
+        file.
+    """
+    tmp_filename = filename + ".tmp"
+    if filename.endswith(".gz"):
+        f = gzip.open(tmp_filename, "wt", encoding="utf-8")
+    else:
+        f = open(tmp_filename, "w", encoding="utf-8")
+    try:
+        with f:
+            yield f
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+def chunk_filename(filename, number):
+    """ Name of the chunk number of filename: 'a.osm.gz' -> 'a - 001.osm.gz' """
+    for ext in (".osm.gz", ".osm"):
+        if filename.endswith(ext):
+            return "{0} - {1:03d}{2}".format(filename[:-len(ext)], number, ext)
+    return "{0} - {1:03d}".format(filename, number)
+
+def index_filename(filename):
+    """ Name of the index of the chunks of filename: 'a.osm.gz' -> 'a.index.json' """
+    for ext in (".osm.gz", ".osm"):
+        if filename.endswith(ext):
+            return filename[:-len(ext)] + ".index.json"
+    return filename + ".index.json"
+
+def write_chunks_index(filename, chunks):
+    """ Write the index of the chunks of filename, chunks being a list of
+        {"file":, "bbox": [minlon, minlat, maxlon, maxlat], "nodes":, "ways":}.
+        Return the name of the index file.
+    """
+    index = index_filename(filename)
+    with atomic_open(index) as f:
+        json.dump({"chunks": chunks}, f, indent=1)
+    return index
+
+def write_chunks(osm_data, filename, tile_size=None, max_nodes=None):
+    """ Write osm_data in several files (see Osm.chunks) and their index.
+        Return the list of the written files, index first.
+    """
+    entries = []
+    filenames = []
+    for number, chunk in enumerate(osm_data.chunks(tile_size, max_nodes)):
+        name = chunk_filename(filename, number + 1)
+        with atomic_open(name) as f:
+            OsmWriter(chunk).write_to_stream(f)
+        entries.append({
+            "file": os.path.basename(name),
+            "bbox": chunk.bbox(),
+            "nodes": len(chunk.nodes),
+            "ways": len(chunk.ways)})
+        filenames.append(name)
+    return [write_chunks_index(filename, entries)] + filenames
+
+
+
+class Tags(dict):
+    """ Immutable tags, shared by all the items having the same tags (see
+        Osm.intern_tags). Shared tags being interned, two of them are equal
+        only if they are the same object. Use Item.mutable_tags() to modify
+        the tags of an item (copy on write).
+    """
+    __slots__ = ("hash",)
+    def __hash__(self):
+        try:
+            return self.hash
+        except AttributeError:
+            self.hash = hash(frozenset(self.items()))
+            return self.hash
+    def read_only(self, *args, **kwargs):
+        raise TypeError("shared tags are read-only, use Item.mutable_tags()")
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
 
+EMPTY_TAGS = Tags()
 
 
 class Item(object):
@@ -154,30 +301,31 @@ class Item(object):
         return int(self.attrs["id"])
     def textid(self):
         return self.type()[0] + str(self.id())
+    def mutable_tags(self):
+        """ Return the tags of the item ready to be modified, copying them
+            if they are shared.
+        """
+        if isinstance(self.tags, Tags):
+            self.tags = dict(self.tags)
+        return self.tags
 
 class Node(Item):
     def __init__(self, attrs,tags=None):
         Item.__init__(self, attrs, tags)
+        self.lonlat = None
     def type(self):
         return "node"
+    def coordinates(self):
+        """ (lon, lat) of the node, parsed from its attributes once. """
+        if self.lonlat is None:
+            self.lonlat = float(self.attrs["lon"]), float(self.attrs["lat"])
+        return self.lonlat
     def lon(self):
-      return float(self.attrs["lon"])
+      return self.coordinates()[0]
     def lat(self):
-      return float(self.attrs["lat"])
+      return self.coordinates()[1]
     def distance(self, node):
-        # http://fr.wikipedia.org/wiki/Distance_du_grand_cercle
-        def square(a): return a*a
-        def degree_to_radian(a): return a * math.pi / 180
-        a_lon = degree_to_radian(float(self.attrs["lon"]))
-        a_lat = degree_to_radian(float(self.attrs["lat"]))
-        b_lon = degree_to_radian(float(node.attrs["lon"]))
-        b_lat = degree_to_radian(float(node.attrs["lat"]))
-        R = 6371000.0 # Earth ray in metter
-        result = 2 * R * math.asin(math.sqrt(
-            square(math.sin((b_lat-a_lat)/2))
-            + math.cos(a_lat)*math.cos(b_lat)*square(math.sin((b_lon-a_lon)/2))
-            ));
-        return result
+        return geometry.haversine_distance(*(self.coordinates() + node.coordinates()))
 
 class Way(Item):
     def __init__(self, attrs,tags=None):
@@ -270,13 +418,49 @@ class OsmParser(object):
             raise Exception("ERROR: unknown tag <"+name+"> in file "
                     + self.filename + "\n")
     def handle_end_element(self,name):
-        pass
+        if name in ("node", "way", "relation"):
+            self.current.tags = self.osm.intern_tags(self.current.tags)
     def handle_char_data(self,data):
         pass
 
+class OsmStreamParser(OsmParser):
+    """ Parser calling handler(item) for each node, way and relation as soon
+        as it is read, instead of keeping them in memory. The returned Osm
+        only holds the attributes and the bounds of the file.
+    """
+    def __init__(self, handler, factory=Osm):
+        OsmParser.__init__(self, factory)
+        self.handler = handler
+    def handle_start_element(self,name, attrs):
+        if name == "node":
+            self.current = Node(attrs)
+        elif name == "way":
+            self.current = Way(attrs)
+        elif name == "relation":
+            self.current = Relation(attrs)
+        else:
+            OsmParser.handle_start_element(self, name, attrs)
+    def handle_end_element(self,name):
+        if name in ("node", "way", "relation"):
+            self.handler(self.current)
+            self.current = None
+
+def quoteattr(value):
+    """ Same as xml.sax.saxutils.quoteattr(), whose module imports
+        urllib.request and slows down the startup of the scripts.
+    """
+    value = value.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+    value = value.replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+    if '"' not in value:
+        return '"' + value + '"'
+    if "'" not in value:
+        return "'" + value + "'"
+    return '"' + value.replace('"', "&quot;") + '"'
+
 class OsmWriter(object):
     def __init__(self, osm):
         self.osm = osm
+        self.tags_text = {} # escaped text of the shared Tags already written
     def write_to_file(self, filename):
         self.output = open(filename, mode="w")
         self.write()
@@ -313,13 +497,19 @@ class OsmWriter(object):
             output.write("\t</relation>\n");
         output.write("</osm>\n");
     def attrs_str(self, attrs):
-        return ("".join([' ' + key + '=' + xml.sax.saxutils.quoteattr(value)
+        return ("".join([' ' + key + '=' + quoteattr(value)
             for key,value in attrs.items()]))#.encode("utf-8")
     def write_tags(self, tags):
-        for key,value in tags.items():
-            value = xml.sax.saxutils.quoteattr(value)
-            self.output.write(
-                ('\t\t<tag k="' + key + '" v=' + value +'/>\n')#.encode("utf-8")
-            )
+        if isinstance(tags, Tags):
+            text = self.tags_text.get(tags)
+            if text is None:
+                text = self.tags_text[tags] = self.tags_str(tags)
+        else:
+            text = self.tags_str(tags)
+        self.output.write(text)
+    def tags_str(self, tags):
+        return "".join([
+            ('\t\t<tag k="' + key + '" v=' + quoteattr(value) +'/>\n')#.encode("utf-8")
+            for key,value in tags.items()])
 
 
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import importlib.util
+
+import pytest
+
+
+DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIRECTORY)
+
+
+def load_script(filename):
+    """Import a script of the repository, whose name is not a module name."""
+    name = os.path.splitext(filename)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(DIRECTORY, filename))
+    module = importlib.util.module_from_spec(spec)
+    # registered for pickle, e.g. for the pool of processes of --lot
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def extract_bdhydro():
+    return load_script("extract-bdhydro.py")
+
+
+@pytest.fixture
+def modify_bdhydro_osmtags():
+    return load_script("modify-bdhydro-osmtags.py")
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import pytest
+
+
+@pytest.fixture
+def cache(extract_bdhydro, tmp_path, monkeypatch):
+    monkeypatch.setattr(extract_bdhydro, "VERBOSE", False)
+    monkeypatch.chdir(tmp_path)
+    return extract_bdhydro.ResultCache(str(tmp_path / "cache"), 2500)
+
+def put(cache, key, filename):
+    with open(filename, "w") as f:
+        f.write(filename * (1000 // len(filename)))
+    cache.put(key, {"files": [filename], "tributary": filename})
+
+
+def test_key_normalisation(extract_bdhydro, cache):
+    key = lambda search: cache.key("troncons.shp", search)
+    assert key("Rivière A") == key("riviere a")
+    # not stripped, as matches_search() does not
+    assert key(" Riviere A ") != key("Riviere A")
+    # codes are not normalized
+    assert key("O5200600") != key("o5200600")
+    assert key("O5200600") != cache.key("autres-troncons.shp", "O5200600")
+    options = extract_bdhydro.ExtractOptions(simplify=5.0)
+    assert key("O5200600") != cache.key("troncons.shp", "O5200600", options)
+
+
+def test_hit_and_miss(cache):
+    assert cache.get("a") is None
+    put(cache, "a", "a.osm.gz")
+    os.remove("a.osm.gz")
+    assert cache.get("a") == {"files": ["a.osm.gz"], "tributary": "a.osm.gz"}
+    with open("a.osm.gz") as f:
+        assert f.read() == "a.osm.gz" * 125
+
+
+def test_least_recently_used_evicted(cache):
+    put(cache, "a", "a.osm.gz")
+    put(cache, "b", "b.osm.gz")
+    os.utime(os.path.join(cache.directory, "a"), (1000, 1000))
+    os.utime(os.path.join(cache.directory, "b"), (2000, 2000))
+    # a is used again, b is now the least recently used entry
+    assert cache.get("a") is not None
+    put(cache, "c", "c.osm.gz")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
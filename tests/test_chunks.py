@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import gzip
+import json
+
+import pytest
+
+import osm
+
+
+class IdentityTransformation(object):
+    """Stands for the osgeo transformation, coordinates are in degrees."""
+    def TransformPoint(self, x, y, z=0):
+        return x, y, z
+
+
+def troncon(xys):
+    return {"properties": {"NOM_C_EAU": "RIVIERE"},
+            "geometry": {"type": "LineString",
+                         "coordinates": [(x, y, 10.0) for x, y in xys]}}
+
+# W0 crosses the border of the tiles (0, 0) and (1, 0), W1 continues it in
+# the tile (1, 0), W2 starts at a vertex of W0.
+TRONCONS = [
+    troncon([(0.2, 0.5), (0.5, 0.5), (0.8, 0.5), (1.2, 0.5)]),
+    troncon([(1.2, 0.5), (1.5, 0.6), (1.8, 0.5)]),
+    troncon([(0.8, 0.5), (0.8, 0.9)]),
+]
+
+
+@pytest.fixture
+def save_chunks(extract_bdhydro, tmp_path, monkeypatch):
+    monkeypatch.setattr(extract_bdhydro, "VERBOSE", False)
+    def save_chunks(tile_size=None, max_nodes=None):
+        filename = str(tmp_path / "riviere.osm.gz")
+        files = extract_bdhydro.save_items_as_osm_chunks(
+            TRONCONS, IdentityTransformation(), filename, tile_size, max_nodes)
+        with open(files[0], encoding="utf-8") as f:
+            index = json.load(f)
+        chunks = []
+        for filename in files[1:]:
+            with gzip.open(filename, "rb") as f:
+                chunks.append(osm.OsmParser().parse_stream(f))
+        return index["chunks"], chunks
+    return save_chunks
+
+def check_chunks(entries, chunks):
+    node_id_by_coord = {}
+    way_ids = set()
+    for entry, chunk in zip(entries, chunks):
+        lons = [node.lon() for node in chunk.nodes.values()]
+        lats = [node.lat() for node in chunk.nodes.values()]
+        assert entry["bbox"] == [min(lons), min(lats), max(lons), max(lats)]
+        assert entry["nodes"] == len(chunk.nodes)
+        assert entry["ways"] == len(chunk.ways)
+        for way in chunk.ways.values():
+            assert all(node_id in chunk.nodes for node_id in way.nodes)
+        # a node written in several chunks keeps its id
+        for node_id, node in chunk.nodes.items():
+            assert node_id_by_coord.setdefault((node.lon(), node.lat()), node_id) == node_id
+        assert way_ids.isdisjoint(chunk.ways)
+        way_ids.update(chunk.ways)
+    assert len(node_id_by_coord) == len(set(node_id_by_coord.values())) == 7
+    assert len(way_ids) == 3
+
+
+def test_tiles(save_chunks):
+    entries, chunks = save_chunks(tile_size=1.0)
+    assert [entry["ways"] for entry in entries] == [2, 1]
+    assert [entry["file"] for entry in entries] == \
+        ["riviere - 001.osm.gz", "riviere - 002.osm.gz"]
+    check_chunks(entries, chunks)
+
+
+def test_max_nodes(save_chunks):
+    entries, chunks = save_chunks(max_nodes=4)
+    assert [(entry["ways"], entry["nodes"]) for entry in entries] == [(1, 4), (1, 3), (1, 2)]
+    check_chunks(entries, chunks)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import pytest
+
+fiona = pytest.importorskip("fiona")
+import fiona.crs
+
+
+SCHEMA = {
+    "geometry": "3D LineString",
+    "properties": {"ID": "str", "NOM_C_EAU": "str", "CODE_CARTH": "str", "DATE_MAJ": "str"},
+}
+
+# L'Alze flows east in D001 and leaves it through an anonymous troncon of
+# D002, which also holds an unrelated river.
+LAYERS = {
+    "D001": [
+        ("TRONEAU0000000001", "L'ALZE", "O5200600", [(800000.0, 6400000.0), (801000.0, 6400000.0)]),
+    ],
+    "D002": [
+        ("TRONEAU0000000002", None, None, [(801000.0, 6400000.0), (802000.0, 6400000.0)]),
+        ("TRONEAU0000000003", "LA LOIRE", "L---0000", [(850000.0, 6400000.0), (851000.0, 6400000.0)]),
+    ],
+}
+
+
+def write_layer(path, troncons):
+    os.makedirs(os.path.dirname(path))
+    with fiona.open(path, "w", driver="ESRI Shapefile", crs=fiona.crs.from_epsg(2154),
+                    schema=SCHEMA) as shp:
+        for troncon_id, name, code, xys in troncons:
+            shp.write({
+                "geometry": {"type": "LineString",
+                             "coordinates": [(x, y, 100.0) for x, y in xys]},
+                "properties": {"ID": troncon_id, "NOM_C_EAU": name, "CODE_CARTH": code,
+                               "DATE_MAJ": "2020-01-01 00:00:00"},
+            })
+
+
+@pytest.fixture
+def departements(tmp_path):
+    for departement, troncons in LAYERS.items():
+        write_layer(str(tmp_path / departement / "HYDROGRAPHIE" / "TRONCON_HYDROGRAPHIQUE.shp"),
+                    troncons)
+    return tmp_path
+
+
+def test_catalogue_of_directory(extract_bdhydro, departements):
+    catalogue_path = str(departements / "departements.json")
+    extract_bdhydro.build_departements_catalogue(str(departements), catalogue_path)
+    with extract_bdhydro.DepartementLayers(catalogue_path) as layers:
+        assert [layer["codes"] for layer in layers.layers] == [["O5200600"], ["L---0000"]]
+        assert layers.layers[1]["names"] == ["la loire"]
+
+
+def test_glob_matching_directories(extract_bdhydro, departements):
+    catalogue_path = str(departements / "departements.json")
+    extract_bdhydro.build_departements_catalogue(str(departements / "D00*"), catalogue_path)
+    with extract_bdhydro.DepartementLayers(catalogue_path) as layers:
+        assert len(layers.layers) == 2
+
+
+def test_unchanged_catalogue_not_rewritten(extract_bdhydro, departements):
+    catalogue_path = str(departements / "departements.json")
+    extract_bdhydro.build_departements_catalogue(str(departements), catalogue_path)
+    os.utime(catalogue_path, ns=(0, 0))
+    identity = extract_bdhydro.shp_identity(catalogue_path)
+    extract_bdhydro.build_departements_catalogue(str(departements), catalogue_path)
+    assert extract_bdhydro.shp_identity(catalogue_path) == identity
+
+
+def test_extract_across_departements(extract_bdhydro, departements):
+    catalogue_path = str(departements / "departements.json")
+    extract_bdhydro.build_departements_catalogue(str(departements), catalogue_path)
+    proj4, name, code_carth, main_items, tributary_items = \
+        extract_bdhydro.extract_troncons_departements(catalogue_path, "alze")
+    assert (name, code_carth) == ("L'ALZE", "O5200600")
+    assert sorted(item["properties"]["ID"] for item in main_items) == \
+        ["TRONEAU0000000001", "TRONEAU0000000002"]
+
+
+def test_relative_paths(extract_bdhydro, departements, monkeypatch):
+    monkeypatch.chdir(str(departements))
+    extract_bdhydro.build_departements_catalogue("D00*", "departements.json")
+    monkeypatch.chdir(str(departements / "D001"))
+    catalogue_path = str(departements / "departements.json")
+    proj4, name, code_carth, main_items, tributary_items = \
+        extract_bdhydro.extract_troncons_departements(catalogue_path, "alze")
+    assert len(main_items) == 2
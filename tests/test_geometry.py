@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import pytest
+
+import geometry
+import osm
+
+
+def coordinates(points):
+    result = geometry.NodeCoordinates()
+    for node_id, (lon, lat) in points.items():
+        result.add(node_id, lon, lat)
+    return result
+
+POINTS = {1: (0.0, 45.0), 2: (0.01, 45.0), 3: (0.01, 45.01), 4: (0.02, 45.02)}
+WAYS = [[1, 2, 3], [3, 4], [2]]
+
+
+def test_way_bearings():
+    starts, ends = geometry.way_bearings(WAYS, coordinates(POINTS))
+    for node_ids, start, end in zip(WAYS, starts, ends):
+        first, second = node_ids[0], node_ids[min(1, len(node_ids) - 1)]
+        before_last, last = node_ids[max(-2, -len(node_ids))], node_ids[-1]
+        assert start == geometry.bearing(*(POINTS[first] + POINTS[second]))
+        assert end == geometry.bearing(*(POINTS[before_last] + POINTS[last]))
+    assert starts[0] == pytest.approx(90)
+    assert ends[0] == pytest.approx(0)
+
+
+def test_way_lengths_and_bboxes():
+    points = coordinates(POINTS)
+    lengths = geometry.way_lengths(WAYS, points)
+    assert list(lengths) == [
+        pytest.approx(geometry.haversine_distance(*(POINTS[1] + POINTS[2]))
+                      + geometry.haversine_distance(*(POINTS[2] + POINTS[3]))),
+        pytest.approx(geometry.haversine_distance(*(POINTS[3] + POINTS[4]))),
+        0]
+    assert geometry.way_bboxes(WAYS, points) == [
+        (0.0, 45.0, 0.01, 45.01), (0.01, 45.01, 0.02, 45.02), (0.01, 45.0, 0.01, 45.0)]
+
+
+def test_running_bbox():
+    data = osm.Osm({})
+    assert data.bbox() is None
+    for node_id, (lon, lat) in POINTS.items():
+        data.create_node({"id": str(node_id), "lon": str(lon), "lat": str(lat)})
+    assert data.bbox() == (0.0, 45.0, 0.02, 45.02)
+    data.remove_node(4)
+    data.remove_node(1)
+    assert data.bbox() == (0.01, 45.0, 0.01, 45.01)
+    assert data.coordinates.lonlat(3) == (0.01, 45.01)
+    way = data.create_way({"id": "1"})
+    way.nodes = [2, 3]
+    assert data.way_lengths()[1] == pytest.approx(data.nodes[2].distance(data.nodes[3]))
+    assert data.way_bboxes() == {1: (0.01, 45.0, 0.01, 45.01)}
+
+
+SQUARE = [[(0, 0), (2, 0), (2, 2), (0, 2), (0, 0)]]
+
+def test_segments_intersect():
+    assert geometry.segments_intersect(0, 0, 2, 2, 0, 2, 2, 0)
+    assert geometry.segments_intersect(0, 0, 1, 1, 1, 1, 2, 0)
+    assert geometry.segments_intersect(0, 0, 2, 0, 1, 0, 3, 0)
+    assert not geometry.segments_intersect(0, 0, 1, 0, 2, 0, 3, 0)
+    assert not geometry.segments_intersect(0, 0, 2, 2, 0, 1, 1, 2)
+
+
+def test_segment_intersects_polygon():
+    # an end inside
+    assert geometry.segment_intersects_polygon(SQUARE, 1, 1, 3, 3)
+    # crossing without any end inside
+    assert geometry.segment_intersects_polygon(SQUARE, -1, 1, 3, 1)
+    assert not geometry.segment_intersects_polygon(SQUARE, -1, 3, 3, 3)
+    # inside the hole only
+    hole = [(0.5, 0.5), (1.5, 0.5), (1.5, 1.5), (0.5, 1.5), (0.5, 0.5)]
+    assert not geometry.segment_intersects_polygon(SQUARE + [hole], 0.8, 1, 1.2, 1)
+    assert geometry.segment_intersects_polygon(SQUARE + [hole], 0.8, 1, 1.8, 1)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import contextlib
+
+import pytest
+
+
+def troncon(troncon_id, xys, name=None, code=None, date="2020-01-01"):
+    return {"properties": {"ID": troncon_id, "NOM_C_EAU": name, "CODE_CARTH": code,
+                           "DATE_MAJ": date},
+            "geometry": {"type": "LineString",
+                         "coordinates": [(x, y, 0.0) for x, y in xys]}}
+
+TRONCONS = [
+    troncon("T1", [(0, 0), (1, 0)], "L'ALZE", "O5200600"),
+    troncon("T2", [(1, 0), (2, 0)], "L'ALZE", "O5200600"),
+    troncon("T3", [(10, 0), (11, 0)], "LA LOIRE", "L---0000"),
+]
+
+MANIFEST = {
+    "shp": None,
+    "rivers": {
+        "alze": {"troncons": ["T1", "T2"], "endpoints": [[0, 0], [1, 0], [2, 0]], "files": []},
+        "O5200600": {"troncons": ["T1", "T2"], "endpoints": [[0, 0], [1, 0], [2, 0]],
+                     "files": []},
+        "loire": {"troncons": ["T3"], "endpoints": [[10, 0], [11, 0]], "files": []},
+    },
+    "pending": [],
+}
+
+
+@pytest.fixture
+def troncons(extract_bdhydro, monkeypatch):
+    """The troncons read by open_troncons(), whatever the path."""
+    troncons = [dict(item, properties=dict(item["properties"])) for item in TRONCONS]
+    monkeypatch.setattr(extract_bdhydro, "open_troncons",
+                        lambda path: contextlib.nullcontext(troncons))
+    monkeypatch.setattr(extract_bdhydro, "VERBOSE", False)
+    return troncons
+
+def affected(extract_bdhydro, previous_dates):
+    changes = extract_bdhydro.scan_troncons_changes("troncons.shp", previous_dates)
+    return sorted(extract_bdhydro.get_affected_searches(MANIFEST, *changes[1:]))
+
+def dates_of(troncons):
+    return {item["properties"]["ID"]: item["properties"]["DATE_MAJ"] for item in troncons}
+
+
+def test_scan_dates_only(extract_bdhydro, troncons):
+    dates, changed_ids, changed_xys, changed_codes, changed_names = \
+        extract_bdhydro.scan_troncons_changes("troncons.shp", {}, collect_changes=False)
+    assert dates == {"T1": "2020-01-01", "T2": "2020-01-01", "T3": "2020-01-01"}
+    assert not (changed_ids or changed_xys or changed_codes or changed_names)
+
+
+def test_unchanged(extract_bdhydro, troncons):
+    assert affected(extract_bdhydro, dates_of(troncons)) == []
+
+
+def test_changed_troncon(extract_bdhydro, troncons):
+    previous_dates = dates_of(troncons)
+    troncons[2]["properties"]["DATE_MAJ"] = "2021-01-01"
+    dates, changed_ids, changed_xys, changed_codes, changed_names = \
+        extract_bdhydro.scan_troncons_changes("troncons.shp", previous_dates)
+    assert changed_ids == {"T3"}
+    assert changed_codes == {"L---0000"}
+    assert changed_names == {"la loire"}
+    assert affected(extract_bdhydro, previous_dates) == ["loire"]
+
+
+def test_removed_troncon(extract_bdhydro, troncons):
+    previous_dates = dates_of(troncons)
+    del troncons[1]
+    assert affected(extract_bdhydro, previous_dates) == ["O5200600", "alze"]
+
+
+def test_new_troncon_at_river_endpoint(extract_bdhydro, troncons):
+    previous_dates = dates_of(troncons)
+    troncons.append(troncon("T4", [(2, 5), (2, 0)]))
+    assert affected(extract_bdhydro, previous_dates) == ["O5200600", "alze"]
+
+
+def test_new_troncon_matching_code_or_name(extract_bdhydro, troncons):
+    previous_dates = dates_of(troncons)
+    troncons.append(troncon("T5", [(20, 0), (21, 0)], code="O5200600"))
+    assert affected(extract_bdhydro, previous_dates) == ["O5200600"]
+    del troncons[-1]
+    troncons.append(troncon("T6", [(20, 0), (21, 0)], name="La Loire aval"))
+    assert affected(extract_bdhydro, previous_dates) == ["loire"]
+
+
+def test_update_without_previous_dates(extract_bdhydro, troncons, monkeypatch, tmp_path):
+    extracted = []
+    def extract_river(shp_path, search, cache=None, options=None):
+        extracted.append(search)
+        return dict(MANIFEST["rivers"][search])
+    monkeypatch.setattr(extract_bdhydro, "extract_river", extract_river)
+    manifest_filename = str(tmp_path / "rivieres.json")
+    extract_bdhydro.extract_rivers_with_manifest("troncons.shp", ["alze", "loire"],
+                                                 manifest_filename, False)
+    assert extracted == ["alze", "loire"]
+    # the dates of the last scan are lost: every river is updated
+    os.remove(extract_bdhydro.get_troncons_filename(manifest_filename))
+    del extracted[:]
+    extract_bdhydro.extract_rivers_with_manifest("troncons.shp", [], manifest_filename, True)
+    assert sorted(extracted) == ["alze", "loire"]
+    del extracted[:]
+    extract_bdhydro.extract_rivers_with_manifest("troncons.shp", [], manifest_filename, True)
+    assert extracted == []
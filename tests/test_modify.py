@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import argparse
+
+import pytest
+
+from conftest import DIRECTORY
+
+
+OPTIONS = argparse.Namespace(low_memory=False, simplify=None, tile_size=None, max_nodes=None)
+ALZE = os.path.join(DIRECTORY, "O5200600 - l'Alze - tributary.osm.gz")
+
+
+@pytest.fixture
+def modify(modify_bdhydro_osmtags, monkeypatch):
+    monkeypatch.setattr(modify_bdhydro_osmtags, "VERBOSE", False)
+    return modify_bdhydro_osmtags
+
+
+def test_batch_output_filename(modify_bdhydro_osmtags):
+    output_filename = modify_bdhydro_osmtags.batch_output_filename
+    assert output_filename("out/{nom}.osm", "in/a - tributary.osm.gz") == "out/a - tributary.osm"
+    # the other braces are not format fields
+    assert output_filename("out/{x} {nom}.osm", "in/a.shp") == "out/{x} a.osm"
+
+
+def test_batch_same_output(modify_bdhydro_osmtags, tmp_path):
+    for name in ("a.osm", "a.osm.gz"):
+        (tmp_path / name).write_bytes(b"")
+    with pytest.raises(Exception, match="have the same output"):
+        modify_bdhydro_osmtags.process_batch(
+            str(tmp_path), str(tmp_path / "{nom}-modified.osm"), OPTIONS)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.osm", "a.osm.gz"]
+
+
+def test_low_memory_same_output(modify, tmp_path):
+    outputs = []
+    for low_memory in (False, True):
+        output_filename = str(tmp_path / "alze-{0}.osm".format(low_memory))
+        modify.process_file(ALZE, output_filename,
+                            argparse.Namespace(**dict(vars(OPTIONS), low_memory=low_memory)))
+        with open(output_filename, "rb") as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+    assert b"<way" in outputs[0]
+
+
+def test_batch_failures(modify, tmp_path, capsys):
+    input_directory = tmp_path / "in"
+    input_directory.mkdir()
+    shutil.copy(ALZE, str(input_directory / "alze.osm.gz"))
+    (input_directory / "bad.osm").write_text("<osm><node")
+    output_directory = tmp_path / "out"
+    output_directory.mkdir()
+    failures = modify.process_batch(
+        str(input_directory), str(output_directory / "{nom}.osm"), OPTIONS, workers=2)
+    assert failures == 1
+    errors = capsys.readouterr().err.splitlines()
+    assert len(errors) == 1
+    assert errors[0].startswith("ERROR {0}: ExpatError".format(input_directory / "bad.osm"))
+    # the other files are still processed
+    assert sorted(path.name for path in output_directory.iterdir()) == ["alze.osm"]
+    modify.process_file(ALZE, str(tmp_path / "alze.osm"), OPTIONS)
+    assert (output_directory / "alze.osm").read_bytes() == (tmp_path / "alze.osm").read_bytes()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+import math
+import sqlite3
+
+import pytest
+
+
+def troncon(troncon_id, xys, name=None, code=None, sens="Sens direct"):
+    return {"properties": {"ID": troncon_id, "NOM_C_EAU": name, "CODE_CARTH": code,
+                           "SENS_ECOUL": sens},
+            "geometry": {"type": "LineString",
+                         "coordinates": [(x, y, 0.0) for x, y in xys]}}
+
+# The river X flows east to (2, 0). Two anonymous streams L1 and L2 join at
+# its source, and the stream Y, drawn against its flow, joins it at (1, 0).
+TRONCONS = [
+    troncon("X1", [(0, 0), (1, 0)], "RIVIERE X", "X0000001"),
+    troncon("X2", [(1, 0), (2, 0)], "RIVIERE X", "X0000001"),
+    troncon("L1", [(-1, 1), (0, 0)]),
+    troncon("L2", [(-1, -1), (0, 0)]),
+    troncon("Y1", [(1, 0), (1, 1)], "RUISSEAU Y", "Y0000001", "Sens inverse"),
+    troncon("Z1", [(10, 0), (11, 0)], "RIVIERE Z", "Z0000001"),
+]
+
+
+@pytest.fixture
+def db_path(extract_bdhydro, tmp_path, monkeypatch):
+    monkeypatch.setattr(extract_bdhydro, "VERBOSE", False)
+    db_path = str(tmp_path / "troncons.sqlite")
+    extract_bdhydro.write_troncons_sqlite(
+        db_path, "+proj=lcc", ["troncons.shp"], len(TRONCONS), enumerate(TRONCONS))
+    extract_bdhydro.build_catchments(db_path)
+    return db_path
+
+def catchments(db_path):
+    """Return the catchment rows by troncon ID."""
+    connection = sqlite3.connect(db_path)
+    rows = connection.execute(
+        "SELECT t.id, c.parent, c.first, c.last, c.strahler, c.upstream_length"
+        " FROM catchment c JOIN troncon t ON t.fid = c.fid").fetchall()
+    connection.close()
+    return {row[0]: row[1:] for row in rows}
+
+def upstream(rows, troncon_id):
+    parent, first, last, strahler, length = rows[troncon_id]
+    return sorted(i for i, row in rows.items() if first <= row[1] <= last)
+
+def ids(items):
+    return sorted(item["properties"]["ID"] for item in items)
+
+
+def test_catchment_intervals(db_path):
+    rows = catchments(db_path)
+    assert upstream(rows, "X2") == ["L1", "L2", "X1", "X2", "Y1"]
+    assert upstream(rows, "X1") == ["L1", "L2", "X1"]
+    assert upstream(rows, "Y1") == ["Y1"]
+    assert upstream(rows, "Z1") == ["Z1"]
+    assert rows["X2"][0] is None
+    assert rows["Y1"][0] == rows["X1"][0] == 1
+
+
+def test_strahler_order_and_length(db_path):
+    rows = catchments(db_path)
+    strahler = {troncon_id: row[3] for troncon_id, row in rows.items()}
+    assert strahler == {"L1": 1, "L2": 1, "X1": 2, "Y1": 1, "X2": 2, "Z1": 1}
+    assert rows["X2"][4] == pytest.approx(3 + 2 * math.sqrt(2))
+
+
+def test_tributaries(extract_bdhydro, db_path):
+    proj4, name, code_carth, main_items, tributary_items = \
+        extract_bdhydro.extract_troncons_sqlite(db_path, "X0000001")
+    assert (name, code_carth) == ("RIVIERE X", "X0000001")
+    assert ids(main_items) == ["L1", "L2", "X1", "X2"]
+    assert ids(tributary_items) == ["L1", "L2", "X1", "X2", "Y1"]
+
+
+def test_minimum_order(extract_bdhydro, db_path):
+    proj4, name, code_carth, main_items, tributary_items = \
+        extract_bdhydro.extract_troncons_sqlite(db_path, "ruisseau", min_order=2)
+    assert ids(tributary_items) == ["Y1"]
+    proj4, name, code_carth, main_items, tributary_items = \
+        extract_bdhydro.extract_troncons_sqlite(db_path, "X0000001", min_order=2)
+    assert ids(tributary_items) == ["L1", "L2", "X1", "X2"]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with it. If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+def surface(surface_id, x, y, size=1):
+    ring = [(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]
+    return {"properties": {"ID": surface_id},
+            "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+def troncon(xys, surface_ids=None):
+    return {"properties": {"ID_S_HYDRO": surface_ids},
+            "geometry": {"type": "LineString",
+                         "coordinates": [(x, y, 0.0) for x, y in xys]}}
+
+def selected(index, items):
+    return [s["properties"]["ID"] for s in index.select(items)]
+
+
+def test_select_surfaces(extract_bdhydro):
+    index = extract_bdhydro.SurfaceIndex([
+        surface("A", 0, 0), surface("B", 2, 0), surface("C", 4, 0),
+        surface("D", 6, 0), surface("E", 0, 5)])
+    # a vertex in A, a segment crossing B without any vertex in it,
+    # D linked by its ID, C and E apart
+    items = [troncon([(0.5, 0.5), (1.5, 0.5), (3.5, 0.5)]),
+             troncon([(3.5, 2), (6, 2)], "D")]
+    assert selected(index, items) == ["A", "B", "D"]
+    # a single point
+    assert selected(index, [troncon([(4.5, 0.5)])]) == ["C"]